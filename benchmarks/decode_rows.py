@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the decoding of [incr tsdb()] rows.
+
+A synthetic `result` table (11 fields per row, including a derivation
+and an MRS) is decoded with the original implementation (a regular
+expression substitution on every field) and with
+:py:func:`delphin.itsdb.decode_rows`, once where every row contains
+escapes and once where none do. The best of several runs is reported.
+
+Usage:
+    python benchmarks/decode_rows.py [ROWS] [RUNS]
+"""
+
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from delphin import itsdb  # noqa: E402
+
+# the decoding used before the fast path was added
+_character_unescapes = {'\\s': '@', '\\n': '\n', '\\\\': '\\'}
+_unescape_func = lambda m: _character_unescapes[m.group(0)]
+_unescape_re = re.compile(r'(\\s|\\n|\\\\)')
+
+
+def old_decode_row(line):
+    fields = line.strip().split('@')
+    return [_unescape_re.sub(_unescape_func, f) for f in fields]
+
+
+def make_lines(n, escaped):
+    derivation = ('(root_strict (1 hd-cmp_u_c 0.5 0 3 (2 n_-_c-pl_le 0 0 1 '
+                  '("dogs" 3 "token [ +FORM dogs ]"))))')
+    mrs = ('[ LTOP: h0 INDEX: e2 [ e SF: prop TENSE: pres ] '
+           'RELS: < [ _dog_n_1<0:4> LBL: h4 ARG0: x3 ] '
+           '[ _bark_v_1<5:10> LBL: h1 ARG0: e2 ARG1: x3 ] > '
+           'HCONS: < h0 qeq h1 > ]')
+    if escaped:
+        derivation += ' @ \n'
+        mrs += ' @ \n'
+    derivation = itsdb.escape(derivation)
+    mrs = itsdb.escape(mrs)
+    return [
+        '@'.join([str(i), str(i % 10), str(i % 7), '12', '34', '56', '789',
+                  '1.5', 'tree', derivation, mrs]) + '\n'
+        for i in range(n)
+    ]
+
+
+def best_of(runs, function, lines):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        for _ in function(lines):
+            pass
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(n=200000, runs=3):
+    old = lambda lines: map(old_decode_row, lines)
+    for escaped in (True, False):
+        lines = make_lines(n, escaped)
+        assert list(old(lines)) == list(itsdb.decode_rows(lines))
+        print('{} rows, {}:'.format(
+            n, 'every row has escapes' if escaped else 'no escapes'))
+        print('  old: {:.2f}s'.format(best_of(runs, old, lines)))
+        print('  new: {:.2f}s'.format(best_of(runs, itsdb.decode_rows,
+                                              lines)))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+Benchmark reading a filtered [incr tsdb()] table with worker processes.
+
+A synthetic profile with a large `result` table (11 fields per row,
+including a derivation and an MRS, with escapes in every row) is read
+with :py:meth:`delphin.itsdb.ItsdbProfile.read_table` and a compiled
+filter expression that keeps about one row in ten, first serially and
+then with worker processes that send back only the offsets of the rows
+that pass. The best of several runs is reported.
+
+Usage:
+    python benchmarks/parallel_filtering.py [ROWS] [RUNS] [WORKERS]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+sys.path.insert(0, os.path.dirname(__file__))
+
+from delphin import itsdb  # noqa: E402
+from decode_rows import make_lines  # noqa: E402
+
+_relations = '''result:
+  parse-id :integer :key
+  result-id :integer
+  time :integer
+  r-ctasks :integer
+  r-ftasks :integer
+  r-etasks :integer
+  size :integer
+  r-aedges :float
+  r-pedges :string
+  derivation :string
+  mrs :string
+'''
+
+
+def make_profile(root, n):
+    path = os.path.join(root, 'profile')
+    os.makedirs(path)
+    with open(os.path.join(path, 'relations'), 'w') as f:
+        f.write(_relations)
+    with open(os.path.join(path, 'result'), 'w') as f:
+        f.writelines(make_lines(n, True))
+    return path
+
+
+def best_of(runs, function):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        count = sum(1 for _ in function())
+        times.append(time.perf_counter() - start)
+    return min(times), count
+
+
+def main(n=400000, runs=3, workers=None):
+    root = tempfile.mkdtemp()
+    try:
+        prof = itsdb.ItsdbProfile(make_profile(root, n), index=False)
+        prof.add_filter('result', None, 'result-id = 3')
+        if workers is None:
+            workers = [1, 2, 4]
+        else:
+            workers = [workers]
+        print('{} rows, filter "result-id = 3" ({} CPUs):'
+              .format(n, os.cpu_count()))
+        serial, count = best_of(runs, lambda: prof.read_table('result'))
+        print('  workers=0: {:.2f}s ({} rows)'.format(serial, count))
+        for w in workers:
+            t, c = best_of(runs, lambda: prof.read_table('result', workers=w))
+            assert c == count
+            print('  workers={}: {:.2f}s'.format(w, t))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:4]))
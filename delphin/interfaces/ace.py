@@ -3,28 +3,227 @@
 
 import logging
 import os
+import re
+import math
+import threading
+from time import perf_counter
+from queue import Queue
+from itertools import chain
+from collections import deque
+from collections.abc import Mapping
 from subprocess import (check_call, CalledProcessError, Popen, PIPE, STDOUT)
+from delphin import itsdb
+
+# the default number of inputs sent to ACE before their responses are read
+_default_in_flight = 16
+# the default number of inputs written to ACE at once when pipelining
+_default_batch_size = 8
+# seconds ACE is given beyond its own --timeout before it is killed
+_timeout_grace = 5
+# statistics reported on ACE's NOTE lines, by the names they get in the
+# STATS of responses (for each input) or the summary (for each run)
+_note_patterns = [
+    re.compile(r'(?P<readings>\d+) readings, added (?P<edges>\d+) / '
+               r'(?P<edges_total>\d+) edges to chart '
+               r'\((?P<fully_instantiated>\d+) fully instantiated, '
+               r'(?P<actives_used>\d+) actives used, '
+               r'(?P<passives_used>\d+) passives used\)'
+               r'(?:\s+RAM: (?P<ram_kb>\d+)k)?'),
+    re.compile(r'(?P<passive_edges>\d+) passive, (?P<active_edges>\d+) '
+               r'active edges in final generation chart; built '
+               r'(?P<passives_built>\d+) passives total\. '
+               r'\[(?P<results>\d+) results\]'),
+    re.compile(r'(?:parsed|generated|transferred) (?P<processed>\d+) / '
+               r'(?P<sentences>\d+) sentences, avg (?P<avg_ram_kb>\d+)k, '
+               r'time (?P<time>[\d.]+)s'),
+]
+
+
+def note_stats(message):
+    """
+    Return a dictionary of the numbers in an ACE `NOTE:` message.
+
+    Per-item messages give `readings`, `edges` and `edges_total` (from
+    "added N / M edges"), `fully_instantiated`, `actives_used`,
+    `passives_used`, and `ram_kb` for parsing, and `passive_edges`,
+    `active_edges`, `passives_built`, and `results` for generation.
+    The message at the end of a run gives `processed`, `sentences`,
+    `avg_ram_kb`, and `time` (in seconds). Other messages give an
+    empty dictionary.
+
+    Args:
+        message: the text after `NOTE: `
+    Returns:
+        A dictionary mapping statistic names to integers (or a float
+        for `time`)
+    """
+    for pattern in _note_patterns:
+        match = pattern.search(message)
+        if match:
+            return dict(
+                (name, float(value) if '.' in value else int(value))
+                for name, value in match.groupdict().items()
+                if value is not None
+            )
+    return {}
+
+
+def _add_latency(response, start, sent, received, end):
+    # record Python-side timings (in seconds) in a response's STATS
+    if isinstance(response, dict):
+        response.setdefault('STATS', {}).update({
+            'send': sent - start,
+            'receive': end - received,
+            'latency': end - start
+        })
+    return response
+
 
 class AceProcess(object):
+    """
+    An ACE process for a compiled grammar.
+
+    Limits on each input are passed to ACE with its own options, and
+    `timeout` is also enforced from Python: if ACE has not answered
+    within `timeout` seconds (plus a grace period for ACE to stop by
+    itself), the process is killed and restarted, and the response is
+    from :py:meth:`timeout_response`.
+
+    Args:
+        grm: the path to the compiled grammar image
+        cmdargs: a list of further command-line arguments for ACE
+        executable: the path to the ACE binary (default: `ace`)
+        timeout: the maximum number of seconds for each input
+        max_chart_megabytes: ACE's memory limit for the chart
+        max_unpack_megabytes: ACE's memory limit for unpacking
+        max_results: if not None, ACE only returns the top
+            `max_results` results for each input
+        lazy: if True, parse results are read-only
+            :py:class:`AceResult` objects that are only split when
+            accessed; otherwise they are dictionaries
+    """
 
     _cmdargs = []
 
-    def __init__(self, grm, cmdargs=None, executable=None, **kwargs):
+    def __init__(self, grm, cmdargs=None, executable=None, timeout=None,
+                 max_chart_megabytes=None, max_unpack_megabytes=None,
+                 max_results=None, lazy=False, **kwargs):
         if not os.path.isfile(grm):
             raise ValueError("Grammar file %s does not exist." % grm)
         self.grm = grm
         self.cmdargs = cmdargs or []
         self.executable = executable or 'ace'
+        self.timeout = timeout
+        self.lazy = lazy
+        self._limitargs = []
+        if timeout is not None:
+            self._limitargs.append('--timeout={}'.format(
+                max(1, int(math.ceil(timeout)))
+            ))
+        if max_chart_megabytes is not None:
+            self._limitargs.append(
+                '--max-chart-megabytes={}'.format(int(max_chart_megabytes))
+            )
+        if max_unpack_megabytes is not None:
+            self._limitargs.append(
+                '--max-unpack-megabytes={}'.format(int(max_unpack_megabytes))
+            )
+        if max_results is not None:
+            self._limitargs.extend(['-n', str(int(max_results))])
         self._open()
 
     def _open(self):
         self._p = Popen(
-            [self.executable, '-g', self.grm] + self._cmdargs + self.cmdargs,
+            [self.executable, '-g', self.grm] + self._cmdargs +
+            self._limitargs + self.cmdargs,
             stdin=PIPE,
             stdout=PIPE,
             stderr=STDOUT,
             universal_newlines=True
         )
+        self._eof = False
+        self._expired = False
+        self._waiting = False  # if a response is being read
+        self._lock = threading.Lock()
+        self.summary = {}
+
+    def _readline(self):
+        line = self._p.stdout.readline()
+        if not line:
+            # ACE closed its output, so it has exited or is exiting
+            self._eof = True
+        return line
+
+    def alive(self):
+        """
+        Return True if the ACE process is still running.
+        """
+        return not self._eof and self._p.poll() is None
+
+    def restart(self):
+        """
+        Kill the ACE process (if it is still running) and start a new
+        one with the same grammar and arguments.
+        """
+        if self._p.poll() is None:
+            self._p.kill()
+        for f in (self._p.stdin, self._p.stdout):
+            try:
+                f.close()
+            except (OSError, ValueError):
+                pass
+        self._p.wait()
+        self._open()
+
+    def error_response(self, message):
+        """
+        Return a response for an input that could not be processed,
+        with `message` as its error.
+        """
+        return {'ERRORS': [message], 'TIMEOUT': False}
+
+    def timeout_response(self):
+        """
+        Return a response for an input that ACE did not finish within
+        the timeout. It is an error response whose `TIMEOUT` value is
+        True.
+        """
+        response = self.error_response(
+            'timed out after {} seconds'.format(self.timeout)
+        )
+        response['TIMEOUT'] = True
+        return response
+
+    def _expire(self):
+        # called by the timeout watchdog; the process is only killed if
+        # the response is still being read
+        with self._lock:
+            if self._waiting:
+                self._expired = True
+                self._p.kill()
+
+    def _receive_in_time(self):
+        # Return (response, expired) for the next response, where
+        # `expired` is True if ACE was killed for exceeding the timeout
+        # and has to be restarted. If ACE was only killed after it
+        # finished the response, the response is kept.
+        if self.timeout is None:
+            return self.receive(), False
+        with self._lock:
+            self._waiting = True
+        timer = threading.Timer(self.timeout + _timeout_grace, self._expire)
+        timer.start()
+        try:
+            response = self.receive()
+        finally:
+            timer.cancel()
+            with self._lock:
+                self._waiting = False
+                expired, self._expired = self._expired, False
+        if expired and self._eof:
+            # the response was cut off when the process was killed
+            response = self.timeout_response()
+        return response, expired
 
     def __enter__(self):
         return self
@@ -33,45 +232,271 @@ class AceProcess(object):
         self.close()
         return False  # don't try to handle any exceptions
 
+    def _serialize(self, datum):
+        return datum.rstrip()
+
     def send(self, datum):
-        self._p.stdin.write(datum.rstrip() + '\n')
+        self._p.stdin.write(self._serialize(datum) + '\n')
+        self._p.stdin.flush()
+
+    def send_many(self, data):
+        """
+        Send each datum in `data` to ACE with a single write.
+        """
+        self._p.stdin.write(''.join(self._serialize(datum) + '\n'
+                                    for datum in data))
         self._p.stdin.flush()
 
     def receive(self):
         return self._p.stdout
 
     def interact(self, datum):
+        """
+        Send `datum` to ACE and return the response. Python-side
+        timings are added to the `STATS` of the response: `send` and
+        `receive` are the seconds spent writing the input and reading
+        the response, and `latency` the seconds from the start of one
+        to the end of the other.
+        """
+        start = perf_counter()
         self.send(datum)
-        result = self.receive()
-        return result
+        sent = perf_counter()
+        result, expired = self._receive_in_time()
+        if expired:
+            logging.warning('ACE timed out; restarting the process')
+            self.restart()
+        return _add_latency(result, start, sent, sent, perf_counter())
+
+    def interact_many(self, data, in_flight=None, batch_size=None):
+        """
+        Yield the response for each datum in `data`, in order.
+
+        A background thread sends the data to ACE while the responses
+        are read, keeping up to `in_flight` data sent but not yet
+        received, so ACE can start on the next datum while Python
+        processes the last response. ACE answers its inputs in order,
+        so responses are yielded in the order of `data`. Note that
+        `data` is iterated in the background thread. Timings are added
+        to the responses as for :py:meth:`interact`, except that
+        `latency` includes the time an input waited while ACE worked
+        on the inputs sent before it.
+
+        When several inputs can be sent at once, up to `batch_size` of
+        them are serialized and written together (see
+        :py:meth:`send_many`).
+
+        If the process has a `timeout` and an input is not answered in
+        time, the process is killed and restarted, the input gets the
+        response from :py:meth:`timeout_response`, and the inputs that
+        were sent after it are sent again to the new process.
+
+        Args:
+            data: an iterable of inputs for ACE
+            in_flight: the maximum number of inputs sent ahead of the
+                responses read; if None, `_default_in_flight` is used
+            batch_size: the maximum number of inputs written at once;
+                if None, `_default_batch_size` is used
+        Yields:
+            The response for each datum, as from :py:meth:`receive`
+        """
+        if in_flight is None:
+            in_flight = _default_in_flight
+        if batch_size is None:
+            batch_size = _default_batch_size
+        items = iter(data)
+        while items is not None:
+            # after a timeout, the pipeline returns the data to resend
+            items = yield from self._pipeline(items, in_flight, batch_size)
+
+    def _pipeline(self, items, in_flight, batch_size):
+        slots = threading.Semaphore(max(1, in_flight))
+        sent = Queue()
+        # [datum, start, end] for each datum sent but not yet answered
+        outstanding = deque()
+        stop = threading.Event()
+        failures = []
+
+        def feed():
+            exhausted = False
+            try:
+                while not exhausted:
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    # each datum in the batch holds a slot; take more
+                    # data only while slots are free
+                    batch = []
+                    for datum in items:
+                        batch.append(datum)
+                        if (len(batch) >= batch_size or
+                                not slots.acquire(blocking=False)):
+                            break
+                    else:
+                        exhausted = True
+                        slots.release()  # acquired for no datum
+                    if batch:
+                        start = perf_counter()
+                        entries = [[datum, start, None] for datum in batch]
+                        outstanding.extend(entries)
+                        self.send_many(batch)
+                        end = perf_counter()
+                        for entry in entries:
+                            entry[2] = end
+                            sent.put(entry)
+            except Exception as exc:
+                failures.append(exc)
+                sent.put(exc)
+            else:
+                sent.put(None)
+
+        writer = threading.Thread(target=feed)
+        writer.daemon = True
+        writer.start()
+        try:
+            while True:
+                entry = sent.get()
+                if entry is None:
+                    return None
+                elif isinstance(entry, Exception):
+                    raise entry
+                received = perf_counter()
+                response, expired = self._receive_in_time()
+                outstanding.popleft()
+                slots.release()
+                yield _add_latency(response, entry[1], entry[2], received,
+                                   perf_counter())
+                if expired:
+                    logging.warning('ACE timed out; restarting the process')
+                    stop.set()
+                    slots.release()
+                    writer.join()
+                    # writing fails once the process is killed, but
+                    # other errors (e.g., from `items`) are raised
+                    for exc in failures:
+                        if not isinstance(exc, (OSError, ValueError)):
+                            raise exc
+                    self.restart()
+                    retry = [entry[0] for entry in outstanding]
+                    return chain(retry, items)
+        finally:
+            # let the writer stop if the responses are not all consumed
+            stop.set()
+            slots.release()
 
     def read_result(self, result):
         return result
 
     def close(self):
+        """
+        Close ACE's input and wait for it to exit. Statistics that ACE
+        reports for the whole run (see :py:func:`note_stats`) are
+        stored in :py:attr:`summary`.
+        """
         self._p.stdin.close()
         for line in self._p.stdout:
             logging.debug('ACE cleanup: {}'.format(line.rstrip()))
+            if line.startswith('NOTE: '):
+                self.summary.update(note_stats(line[6:]))
         retval = self._p.wait()
         return retval
 
 
-class AceParser(AceProcess):
+def _split_result(line):
+    # the MRS and derivation strings of a parse result line
+    mrs, _, deriv = line.partition(' ; ')
+    return {'MRS': mrs.strip(), 'DERIV': deriv.strip()}
 
-    def receive(self):
-        response = {
+
+class AceResult(Mapping):
+    """
+    A parse result from ACE, as a mapping with `MRS` and `DERIV` keys
+    for the MRS and derivation strings. Parsers only give these
+    results if they are created with `lazy=True`; otherwise results
+    are plain dictionaries.
+
+    The line from ACE is kept as is and only split when one of the
+    strings is accessed, and the MRS is only deserialized when the
+    :py:attr:`xmrs` attribute is first accessed. The mapping is
+    read-only; `dict(result)` gives a mutable (and JSON-serializable)
+    copy.
+    """
+
+    __slots__ = ('line', '_fields', '_xmrs')
+    _keys = ('MRS', 'DERIV')
+
+    def __init__(self, line):
+        self.line = line
+        self._fields = None
+        self._xmrs = None
+
+    def _split(self):
+        if self._fields is None:
+            self._fields = _split_result(self.line)
+        return self._fields
+
+    def __getitem__(self, key):
+        return self._split()[key]
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return 'AceResult({!r})'.format(self.line)
+
+    @property
+    def xmrs(self):
+        """
+        The MRS as an Xmrs object, deserialized by
+        :py:func:`delphin.mrs.simplemrs.loads_one` on first access.
+        """
+        if self._xmrs is None:
+            from delphin.mrs import simplemrs
+            self._xmrs = simplemrs.loads_one(self['MRS'])
+        return self._xmrs
+
+
+class AceParser(AceProcess):
+    """
+    An ACE process for parsing.
+
+    The `STATS` of each response hold the numbers on ACE's per-item
+    `NOTE:` line (readings, edge counts, and memory; see
+    :py:func:`note_stats`) and the Python-side timings added by
+    :py:meth:`AceProcess.interact`. ACE only reports the processing
+    time of each item in its [incr tsdb()] output mode
+    (`--tsdb-stdout`), which replaces the result lines this class
+    reads, so per-item time is measured from Python (`latency`), and
+    ACE's own timing for the whole run is in :py:attr:`summary` after
+    the process is closed.
+    """
+
+    def _response(self):
+        return {
             'NOTES': [],
             'WARNINGS': [],
             'ERRORS': [],
             'SENT': None,
-            'RESULTS': []
+            'RESULTS': [],
+            'TIMEOUT': False,
+            'STATS': {}
         }
 
+    def error_response(self, message):
+        response = self._response()
+        response['ERRORS'].append(message)
+        return response
+
+    def receive(self):
+        response = self._response()
+
         blank = 0
 
-        stdout = self._p.stdout
-        line = stdout.readline().rstrip()
-        while True:
+        raw = self._readline()
+        line = raw.rstrip()
+        while raw:
             if line.strip() == '':
                 blank += 1
                 if blank >= 2:
@@ -83,39 +508,70 @@ class AceParser(AceProcess):
                   line.startswith('ERROR')):
                 level, message = line.split(': ', 1)
                 response['{}S'.format(level)].append(message)
+                if level == 'NOTE':
+                    response['STATS'].update(note_stats(message))
             else:
-                mrs, deriv = line.split(' ; ')
-                response['RESULTS'].append({
-                    'MRS': mrs.strip(),
-                    'DERIV': deriv.strip()
-                })
-            line = stdout.readline().rstrip()
+                if self.lazy:
+                    response['RESULTS'].append(AceResult(line))
+                else:
+                    response['RESULTS'].append(_split_result(line))
+            raw = self._readline()
+            line = raw.rstrip()
         return response
 
 
 class AceGenerator(AceProcess):
+    """
+    An ACE process for generation. Inputs may be SimpleMRS strings or
+    Xmrs objects, which are serialized by
+    :py:func:`delphin.mrs.simplemrs.dumps_one` when they are sent (so
+    by the background thread in :py:meth:`AceProcess.interact_many`,
+    or by the worker threads of an :py:class:`AcePool`).
+    """
 
     _cmdargs = ['-e']
 
-    def receive(self):
-        response = {
+    def _serialize(self, datum):
+        if isinstance(datum, str):
+            return datum.rstrip()
+        from delphin.mrs import simplemrs
+        return simplemrs.dumps_one(datum, pretty_print=False).strip()
+
+    def _response(self):
+        return {
             'NOTE': None,
             'WARNING': None,
             'ERROR': None,
             'SENT': None,
-            'RESULTS': None
+            'RESULTS': None,
+            'TIMEOUT': False,
+            'STATS': {}
         }
+
+    def error_response(self, message):
+        response = self._response()
+        response['ERROR'] = message
+        response['RESULTS'] = []
+        return response
+
+    def receive(self):
+        response = self._response()
         results = []
 
-        stdout = self._p.stdout
-        line = stdout.readline().rstrip()
-        while not line.startswith('NOTE: '):
+        raw = self._readline()
+        line = raw.rstrip()
+        # stop at the end of the output in case ACE exited
+        while raw and not line.startswith('NOTE: '):
             if line.startswith('WARNING') or line.startswith('ERROR'):
                 level, message = line.split(': ', 1)
                 response[level] = message
             else:
                 results.append(line)
-            line = stdout.readline().rstrip()
+            raw = self._readline()
+            line = raw.rstrip()
+        if line.startswith('NOTE: '):
+            response['NOTE'] = line[6:]
+            response['STATS'].update(note_stats(line[6:]))
         # sometimes error messages aren't prefixed with ERROR
         if line.endswith('[0 results]') and len(results) > 0:
             response['ERROR'] = '\n'.join(results)
@@ -124,6 +580,162 @@ class AceGenerator(AceProcess):
         return response
 
 
+class AcePool(object):
+    """
+    A pool of ACE processes that share the work of parsing or
+    generating a sequence of inputs.
+
+    Each process is driven by a thread that takes the next input as
+    soon as its process is done with the last one, so a long input
+    occupies only one process while the others continue. If a process
+    dies, it is restarted and the input is tried once more; an input
+    that fails twice gets an error response (see
+    :py:meth:`AceProcess.error_response`).
+
+    Args:
+        grm: the path to the compiled grammar image
+        processes: the number of ACE processes; if None, the number of
+            CPUs
+        cls: the :py:class:`AceProcess` subclass for each process,
+            e.g. :py:class:`AceParser` or :py:class:`AceGenerator`
+        kwargs: further arguments for `cls`
+    """
+
+    def __init__(self, grm, processes=None, cls=None, **kwargs):
+        if processes is None:
+            processes = os.cpu_count() or 1
+        self.cls = cls or AceParser
+        self.processes = []
+        try:
+            for _ in range(max(1, processes)):
+                self.processes.append(self.cls(grm, **kwargs))
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False  # don't try to handle any exceptions
+
+    def _interact(self, process, datum):
+        # send `datum` to `process` and return the response, restarting
+        # the process if it has died
+        message = None
+        for attempt in range(2):
+            try:
+                response = process.interact(datum)
+                if process.alive():
+                    return response
+                message = 'ACE exited unexpectedly'
+            except (OSError, ValueError) as exc:
+                message = 'ACE failed: {}'.format(exc)
+            logging.warning('{}; restarting the process'.format(message))
+            process.restart()
+        return process.error_response(message)
+
+    def interact_many(self, data, ordered=True, in_flight=None):
+        """
+        Yield the response for each datum in `data`.
+
+        Args:
+            data: an iterable of inputs for ACE
+            ordered: if True, yield responses in the order of `data`;
+                otherwise yield them as soon as they are ready
+            in_flight: the maximum number of inputs taken from `data`
+                but not yet yielded (which bounds the responses held
+                back for `ordered`); if None, four per process
+        Yields:
+            The response for each datum
+        """
+        if in_flight is None:
+            in_flight = 4 * len(self.processes)
+        slots = threading.Semaphore(max(len(self.processes), in_flight))
+        tasks = Queue()
+        results = Queue()
+        stop = threading.Event()
+
+        def feed():
+            count = 0
+            try:
+                for datum in data:
+                    slots.acquire()
+                    if stop.is_set():
+                        return
+                    tasks.put((count, datum))
+                    count += 1
+            except Exception as exc:
+                results.put((None, exc))
+            else:
+                results.put((None, count))
+            finally:
+                for _ in self.processes:
+                    tasks.put(None)
+
+        def work(process):
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                elif stop.is_set():
+                    continue
+                i, datum = task
+                try:
+                    results.put((i, self._interact(process, datum)))
+                except Exception as exc:
+                    results.put((None, exc))
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        workers = [threading.Thread(target=work, args=(process,))
+                   for process in self.processes]
+        for thread in [feeder] + workers:
+            thread.daemon = True
+            thread.start()
+        try:
+            total = None
+            received = 0
+            pending = {}
+            next_index = 0
+            while total is None or received < total:
+                i, response = results.get()
+                if i is None:
+                    if isinstance(response, Exception):
+                        raise response
+                    total = response
+                    continue
+                received += 1
+                if not ordered:
+                    slots.release()
+                    yield response
+                    continue
+                # hold responses back until those before them are done
+                pending[i] = response
+                while next_index in pending:
+                    slots.release()
+                    yield pending.pop(next_index)
+                    next_index += 1
+        finally:
+            stop.set()
+            for _ in self.processes:
+                slots.release()
+                tasks.put(None)
+            for thread in workers:
+                thread.join()
+
+    def close(self):
+        """
+        Close all ACE processes in the pool.
+        """
+        for process in self.processes:
+            try:
+                process.close()
+            except (OSError, ValueError):
+                process._p.kill()
+
+
 def compile(cfg_path, out_path, log=None):
     #debug('Compiling grammar at {}'.format(abspath(cfg_path)), log)
     try:
@@ -140,26 +752,161 @@ def compile(cfg_path, out_path, log=None):
     #debug('Compiled grammar written to {}'.format(abspath(out_path)), log)
 
 
-def parse_from_iterable(dat_file, data, **kwargs):
-    with AceParser(dat_file, **kwargs) as parser:
-        for datum in data:
-            yield parser.interact(datum)
+def _interact_from_iterable(cls, dat_file, data, in_flight=None,
+                            processes=None, ordered=True, batch_size=None,
+                            **kwargs):
+    if processes is not None and processes > 1:
+        with AcePool(dat_file, processes=processes, cls=cls,
+                     **kwargs) as pool:
+            responses = pool.interact_many(data, ordered=ordered,
+                                           in_flight=in_flight)
+            for response in responses:
+                yield response
+    else:
+        with cls(dat_file, **kwargs) as process:
+            responses = process.interact_many(data, in_flight=in_flight,
+                                              batch_size=batch_size)
+            for response in responses:
+                yield response
+
+
+def parse_from_iterable(dat_file, data, in_flight=None, processes=None,
+                        ordered=True, batch_size=None, **kwargs):
+    return _interact_from_iterable(AceParser, dat_file, data,
+                                   in_flight=in_flight, processes=processes,
+                                   ordered=ordered, batch_size=batch_size,
+                                   **kwargs)
 
 
 def parse(dat_file, datum, **kwargs):
     return next(parse_from_iterable(dat_file, [datum], **kwargs))
 
 
-def generate_from_iterable(dat_file, data, **kwargs):
-    with AceGenerator(dat_file, **kwargs) as generator:
-        for datum in data:
-            yield generator.interact(datum)
+def generate_from_iterable(dat_file, data, in_flight=None, processes=None,
+                           ordered=True, batch_size=None, **kwargs):
+    return _interact_from_iterable(AceGenerator, dat_file, data,
+                                   in_flight=in_flight, processes=processes,
+                                   ordered=ordered, batch_size=batch_size,
+                                   **kwargs)
 
 
 def generate(dat_file, datum, **kwargs):
     return next(generate_from_iterable(dat_file, [datum], **kwargs))
 
 
+def parse_profile(dat_file, source, destination, processes=None,
+                  batch_size=100, key_filter=True, gzip=False, **kwargs):
+    """
+    Parse the items of a profile with ACE and write the results to a
+    new profile.
+
+    If `destination` does not exist, it is created as a skeleton
+    with the relations file of `source` and the `item` rows of
+    `source` that pass its filters. The items of `destination` are
+    then parsed by an :py:class:`AcePool` with `processes` ACE
+    processes, and a `parse` row and the `result` rows of each item
+    are appended to `destination` in input order. Rows are
+    committed (see :py:class:`delphin.itsdb.AppendSession`) after each
+    `batch_size` items, so if parsing is interrupted, calling this
+    function again with the same `destination` discards uncommitted
+    rows and only parses the items that do not have a `parse` row yet.
+
+    Items that ACE fails to parse, times out on, or crashes on get a
+    `parse` row with -1 `readings` and the `error` column set. The
+    `total` column gets the time taken for each item (see
+    :py:meth:`AceProcess.interact`) and `others` the memory ACE
+    reports.
+
+    Args:
+        dat_file: the path to the compiled grammar image
+        source: the path of the profile, or an
+            :py:class:`delphin.itsdb.ItsdbProfile`, with the items
+        destination: the path of the profile to write
+        processes: the number of ACE processes; if None, the number
+            of CPUs
+        batch_size: the number of items parsed between commits
+        key_filter: if True, filter the items of `source` by its
+            cascading key index
+        gzip: if True, new tables are gzipped
+        kwargs: further arguments for :py:class:`AceParser`, such as
+            `timeout` or `executable`
+    Returns:
+        The number of items parsed
+    """
+    if not os.path.exists(destination):
+        if not isinstance(source, itsdb.ItsdbProfile):
+            source = itsdb.ItsdbProfile(source)
+        relations = os.path.join(source.root, itsdb._relations_filename)
+        itsdb.make_skeleton(destination, relations,
+                            source.read_table('item', key_filter=key_filter),
+                            gzip=gzip)
+    profile = itsdb.ItsdbProfile(destination, index=False)
+    with profile.append_session(gzip=gzip) as session:
+        # any uncommitted rows were removed when the session started
+        parse_ids = _key_values(profile, 'parse', 'parse-id')
+        done = _key_values(profile, 'parse', 'i-id')
+        items = [row for row in profile.read_raw_table('item')
+                 if row['i-id'] not in done]
+        run_ids = _key_values(profile, 'run', 'run-id')
+        if run_ids:
+            run_id = max(map(int, run_ids))
+        else:
+            run_id = 1
+            session.append('run', {'run-id': run_id,
+                                   'application': 'ACE',
+                                   'grammar': os.path.basename(dat_file)})
+        parse_id = max(map(int, parse_ids)) + 1 if parse_ids else 1
+        pool = AcePool(dat_file, processes=processes, cls=AceParser,
+                       **kwargs)
+        with pool:
+            responses = pool.interact_many(item['i-input'] for item in items)
+            count = _write_parses(session, items, responses, run_id,
+                                  parse_id, batch_size)
+    return count
+
+
+def _write_parses(session, items, responses, run_id, parse_id, batch_size):
+    count = 0
+    for item, response in zip(items, responses):
+        results = response.get('RESULTS', [])
+        errors = response.get('ERRORS', [])
+        stats = response.get('STATS', {})
+        row = {
+            'parse-id': parse_id,
+            'run-id': run_id,
+            'i-id': item['i-id'],
+            'readings': -1 if errors and not results else len(results),
+            'error': ' '.join(errors)
+        }
+        # times are in milliseconds and memory in bytes
+        if 'latency' in stats:
+            row['total'] = int(stats['latency'] * 1000)
+        if 'ram_kb' in stats:
+            row['others'] = stats['ram_kb'] * 1024
+        session.append('parse', row)
+        for result_id, result in enumerate(results):
+            session.append('result', {
+                'parse-id': parse_id,
+                'result-id': result_id,
+                'mrs': result['MRS'],
+                'derivation': result['DERIV']
+            })
+        parse_id += 1
+        count += 1
+        if count % batch_size == 0:
+            session.commit(item['i-id'])
+    return count
+
+
+def _key_values(profile, table, col):
+    # the values of `col` in `table`, which may not exist yet
+    try:
+        values = profile.key_offsets(table, col)
+    except itsdb.ItsdbError:
+        return set()
+    return set(value for value in values if value.strip())
+
+
 # def do(cmd):
 #     # validate cmd here (e.g. that it has a 'grammar' key, correct 'task', etc)
 #     task = cmd['task']
@@ -12,11 +12,27 @@ skeleton using the :py:func:`make_skeleton` function.
 
 import os
 import re
-from gzip import open as gzopen
+import sys
+import mmap
+import shutil
+import tempfile
+import hashlib
+import getpass
+import pickle
+import time
+import subprocess
+import json
+import random
+import heapq
+from bisect import bisect_left
+from gzip import open as gzopen, GzipFile
 import logging
 from io import TextIOWrapper, BufferedReader
+from array import array
+from datetime import datetime
 from collections import defaultdict, namedtuple, OrderedDict
-from itertools import chain
+from itertools import chain, islice, groupby
+from concurrent.futures import ProcessPoolExecutor
 from delphin._exceptions import ItsdbError
 from delphin.util import safe_int
 
@@ -24,11 +40,24 @@ from delphin.util import safe_int
 # Module variables
 
 _relations_filename = 'relations'
+_cache_dirname = 'pydelphin'
+_key_index_version = 1
+_chunk_size = 16 * 1024 * 1024  # bytes per chunk for parallel filtering
+_io_buffer_size = 1024 * 1024  # bytes buffered when reading/writing tables
+_gzip_compresslevel = 6
+_parallel_gzip_command = 'pigz'
+_columnar_cache_version = 2
+_columnar_block_size = 4096  # rows read or written at a time
+_interned_datatypes = (':string', ':integer', ':date')
+_intern_limit = 65536  # distinct values before a column stops interning
+_sort_buffer_size = 100000  # rows held in memory by external sorts
+_seek_offset = 10000  # smaller offsets are skipped by streaming rows
 _field_delimiter = '@'
 _character_escapes = [
+    # backslashes must be escaped first so the others are not re-escaped
+    ('\\', '\\\\'),
     (_field_delimiter, '\\s'),
-    ('\n', '\\n'),
-    ('\\', '\\\\')
+    ('\n', '\\n')
 ]
 _default_datatype_values = {
     ':integer': '-1'
@@ -36,6 +65,13 @@ _default_datatype_values = {
 _default_field_values = {
     'i-wf': '1'
 }
+_date_formats = [
+    '%d-%b-%Y %H:%M:%S',
+    '%d-%b-%Y %H:%M',
+    '%d-%b-%Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d',
+]
 _primary_keys = [
     ["i-id", "item"],
     ["p-id", "phenomenon"],
@@ -134,7 +170,8 @@ def decode_row(line):
     Decode a raw line from a profile into a list of column values.
 
     Decoding involves splitting the line by the field delimiter ('@' by
-    default) and unescaping special characters.
+    default) and unescaping special characters. Only fields containing
+    a backslash are unescaped, and lines without one are just split.
 
     Args:
         line: a raw line from a [incr tsdb()] profile.
@@ -142,7 +179,30 @@ def decode_row(line):
         A list of column values.
     """
     fields = line.strip().split(_field_delimiter)
-    return list(map(unescape, fields))
+    if '\\' in line:
+        fields = [unescape(f) if '\\' in f else f for f in fields]
+    return fields
+
+
+def decode_rows(lines):
+    """
+    Yield the decoded column values for each raw line in `lines`.
+
+    This is equivalent to calling :py:func:`decode_row` on each line,
+    but avoids the per-line function call overhead.
+
+    Args:
+        lines: an iterable of raw lines from a [incr tsdb()] profile.
+    Yields:
+        Lists of column values.
+    """
+    delimiter = _field_delimiter
+    _unescape = unescape
+    for line in lines:
+        fields = line.strip().split(delimiter)
+        if '\\' in line:
+            fields = [_unescape(f) if '\\' in f else f for f in fields]
+        yield fields
 
 
 def encode_row(fields):
@@ -183,11 +243,6 @@ def escape(string):
     return string
 
 
-_character_unescapes = {'\\s': _field_delimiter, '\\n': '\n', '\\\\': '\\'}
-_unescape_func = lambda m: _character_unescapes[m.group(0)]
-_unescape_re = re.compile(r'(\\s|\\n|\\\\)')
-
-
 def unescape(string):
     """
     Replace [incr tsdb()] escape sequences with the regular equivalents.
@@ -198,11 +253,72 @@ def unescape(string):
     Returns:
         The string with escape sequences replaced
     """
-    return _unescape_re.sub(_unescape_func, string, re.UNICODE)
+    if '\\' not in string:
+        return string
+    # Escape sequences are all a backslash and one character, so after
+    # splitting on escaped backslashes the remaining sequences cannot
+    # overlap and plain replacement is safe.
+    return '\\'.join(
+        part.replace('\\s', _field_delimiter).replace('\\n', '\n')
+        for part in string.split('\\\\')
+    )
+
+
+def _cast_integer(value):
+    if value == '':
+        return None
+    return safe_int(value)
+
+
+def _cast_date(value):
+    if value == '':
+        return None
+    for fmt in _date_formats:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return value
+
+
+_datatype_converters = {
+    ':integer': _cast_integer,
+    ':date': _cast_date,
+}
+
+
+def typed_value(value, datatype):
+    """
+    Convert a decoded column value to a Python object according to the
+    column's datatype. Integers (`:integer`) become `int` and dates
+    (`:date`) become `datetime.datetime`; empty values become `None`,
+    values that cannot be converted and values of other datatypes
+    (e.g. `:string`) are returned unchanged.
+
+    Args:
+        value: the decoded column value
+        datatype: the datatype of the column (e.g. `:integer`)
+    Returns:
+        The converted value
+    """
+    converter = _datatype_converters.get(datatype)
+    if converter is None:
+        return value
+    return converter(value)
+
+
+def _typed_rows(converters, rows):
+    for row in rows:
+        for name, converter in converters:
+            value = row.get(name)
+            if isinstance(value, str):
+                row[name] = converter(value)
+        yield row
 
 
 def _write_table(profile_dir, table_name, rows, fields,
-                 append=False, gzip=False):
+                 append=False, gzip=False, compresslevel=None,
+                 parallel_gzip=False):
     # don't gzip if empty
     rows = iter(rows)
     try:
@@ -211,27 +327,92 @@ def _write_table(profile_dir, table_name, rows, fields,
         gzip = False
     else:
         rows = chain([first_row], rows)
-    if gzip and append:
-        logging.warning('Appending to a gzip file may result in '
-                        'inefficient compression.')
 
     if not os.path.exists(profile_dir):
         raise ItsdbError('Profile directory does not exist: {}'
                          .format(profile_dir))
 
     tbl_filename = os.path.join(profile_dir, table_name)
-    mode = 'a' if append else 'w'
+    mode = 'ab' if append else 'wb'
     if gzip:
-        # text mode only from py3.3; until then use TextIOWrapper
-        #mode += 't'  # text mode for gzip
-        f = TextIOWrapper(gzopen(tbl_filename + '.gz', mode=mode))
+        # appending adds a new gzip member; since rows are written in
+        # large batches each append is one well-compressed member
+        f = _open_gzip_writer(tbl_filename + '.gz', mode,
+                              compresslevel, parallel_gzip)
     else:
         f = open(tbl_filename, mode=mode)
 
-    for row in rows:
-        f.write(make_row(row, fields) + '\n')
+    with f:
+        _write_lines(f, (make_row(row, fields) for row in rows))
 
-    f.close()
+
+def _write_lines(f, lines, buffer_size=None):
+    """
+    Write encoded `lines` (without newlines) to the binary file `f` in
+    batches of about `buffer_size` bytes.
+    """
+    buffer_size = buffer_size or _io_buffer_size
+    batch = []
+    size = 0
+    for line in lines:
+        batch.append(line)
+        size += len(line) + 1
+        if size >= buffer_size:
+            batch.append('')  # final newline
+            f.write('\n'.join(batch).encode('utf-8'))
+            batch = []
+            size = 0
+    if batch:
+        batch.append('')
+        f.write('\n'.join(batch).encode('utf-8'))
+
+
+class _CommandWriter(object):
+    """
+    A binary file-like object that writes through an external
+    compression command (e.g. `pigz`) to a file.
+    """
+
+    def __init__(self, args, filename, mode):
+        self._file = open(filename, mode)
+        try:
+            self._proc = subprocess.Popen(args, stdin=subprocess.PIPE,
+                                          stdout=self._file)
+        except OSError:
+            self._file.close()
+            raise
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def close(self):
+        self._proc.stdin.close()
+        retval = self._proc.wait()
+        self._file.close()
+        if retval != 0:
+            raise ItsdbError('Compression command failed with exit status {}.'
+                             .format(retval))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+def _open_gzip_writer(filename, mode, compresslevel=None,
+                      parallel_gzip=False):
+    if compresslevel is None:
+        compresslevel = _gzip_compresslevel
+    if parallel_gzip:
+        command = shutil.which(_parallel_gzip_command)
+        if command is not None:
+            return _CommandWriter([command, '-c', '-{}'.format(compresslevel)],
+                                  filename, mode)
+        logging.debug('{} not found; compressing with the gzip module.'
+                      .format(_parallel_gzip_command))
+    return gzopen(filename, mode=mode, compresslevel=compresslevel)
 
 
 def make_row(row, fields):
@@ -288,11 +469,15 @@ def filter_rows(filters, rows):
     Yields:
         Rows matching all applicable filters
     """
+    checks = [(col, condition)
+              for (cols, condition) in filters
+              for col in cols]
     for row in rows:
-        if all(condition(row, row.get(col))
-               for (cols, condition) in filters
-               for col in cols
-               if col is None or col in row):
+        for col, condition in checks:
+            if ((col is None or col in row) and
+                    not condition(row, row.get(col))):
+                break
+        else:
             yield row
 
 
@@ -346,6 +531,13 @@ def select_rows(cols, rows, mode='list'):
     Yields:
         Selected data in the form specified by `mode`.
     """
+    cast = _select_cast(mode)
+    for row in rows:
+        data = [row.get(c) for c in cols]
+        yield cast(cols, data)
+
+
+def _select_cast(mode):
     mode = mode.lower()
     if mode == 'list':
         cast = lambda cols, data: data
@@ -357,17 +549,338 @@ def select_rows(cols, rows, mode='list'):
         raise ItsdbError('Invalid mode for select operation: {}\n'
                          '  Valid options include: list, dict, row'
                          .format(mode))
-    for row in rows:
-        data = [row.get(c) for c in cols]
-        yield cast(cols, data)
+    return cast
+
+
+def sample_rows(rows, sample, seed=None):
+    """
+    Yield a sample of `rows` in their original order.
+
+    If `sample` is an integer, a uniform random sample of at most that
+    many rows is chosen by reservoir sampling, so only the sampled rows
+    are kept in memory. If `sample` is a float between 0 and 1, every
+    `round(1/sample)`-th row is yielded, starting from a random row
+    within the first stride, so rows are streamed.
+
+    Args:
+        rows: the rows to sample
+        sample: the number (integer) or fraction (float) of rows
+        seed: the seed for the random choices; the same seed gives the
+            same sample
+    Yields:
+        Rows from `rows`
+    """
+    rng = random.Random(seed)
+    if isinstance(sample, float):
+        stride = _sample_stride(sample)
+        for row in islice(rows, rng.randrange(stride), None, stride):
+            yield row
+    else:
+        for _, row in _reservoir_sample(rows, sample, rng):
+            yield row
+
+
+def _reservoir_sample(items, sample, rng):
+    # A uniform sample of at most `sample` (position, item) pairs from
+    # `items`, in position order. Both sample_rows() and
+    # _sample_positions() use this, so they choose the same rows.
+    if sample < 0:
+        raise ItsdbError('Invalid sample size: {}'.format(sample))
+    reservoir = []
+    for i, item in enumerate(items):
+        if i < sample:
+            reservoir.append((i, item))
+        else:
+            j = rng.randrange(i + 1)
+            if j < sample:
+                reservoir[j] = (i, item)
+    reservoir.sort(key=lambda pair: pair[0])
+    return reservoir
 
 
-def match_rows(rows1, rows2, key, sort_keys=True):
+def limit_rows(rows, limit=None, offset=0):
+    """
+    Yield at most `limit` rows from `rows` after skipping the first
+    `offset` rows. Rows after the last one yielded are never read.
+
+    Args:
+        rows: the rows to limit
+        limit: the maximum number of rows to yield; if None, all rows
+            after `offset` are yielded
+        offset: the number of rows to skip
+    Yields:
+        Rows from `rows`
+    """
+    if (limit is not None and limit < 0) or offset < 0:
+        raise ItsdbError('Invalid limit or offset: {}, {}'
+                         .format(limit, offset))
+    stop = None if limit is None else offset + limit
+    for row in islice(rows, offset, stop):
+        yield row
+
+
+def _sample_stride(sample):
+    if not 0 < sample <= 1:
+        raise ItsdbError('Invalid sample fraction: {}'.format(sample))
+    return max(1, int(round(1.0 / sample)))
+
+
+def _sample_positions(n, sample, seed=None):
+    # Choose positions among `n` rows as sample_rows() would, without
+    # seeing the rows; the same seed gives the same rows.
+    rng = random.Random(seed)
+    if isinstance(sample, float):
+        stride = _sample_stride(sample)
+        return range(rng.randrange(stride), n, stride)
+    return [i for i, _ in _reservoir_sample(range(n), sample, rng)]
+
+
+def _slice_rows(rows, limit=None, offset=0, sample=None, seed=None):
+    if sample is not None:
+        rows = sample_rows(rows, sample, seed=seed)
+    if limit is not None or offset:
+        rows = limit_rows(rows, limit=limit, offset=offset)
+    return rows
+
+
+class _Count(object):
+    def __init__(self):
+        self.n = 0
+
+    def add(self, value):
+        if value is not None:
+            self.n += 1
+
+    def result(self):
+        return self.n
+
+
+class _Sum(object):
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        if value is not None:
+            self.total += value
+
+    def result(self):
+        return self.total
+
+
+class _Mean(object):
+    def __init__(self):
+        self.total = 0
+        self.n = 0
+
+    def add(self, value):
+        if value is not None:
+            self.total += value
+            self.n += 1
+
+    def result(self):
+        return self.total / self.n if self.n else None
+
+
+class _Min(object):
+    # string values are compared as numbers when they are numbers, and
+    # numbers sort before other values, so untyped rows give the same
+    # result as typed ones
+    def __init__(self):
+        self.value = None
+        self.order = None
+
+    def add(self, value):
+        if value is None:
+            return
+        if isinstance(value, str):
+            number = _to_number(value)
+            if number is not None:
+                value = number
+        order = _value_order(value)
+        if self.order is None or self.better(order, self.order):
+            self.value, self.order = value, order
+
+    def better(self, order, current):
+        return order < current
+
+    def result(self):
+        return self.value
+
+
+class _Max(_Min):
+    def better(self, order, current):
+        return order > current
+
+
+def _value_order(value):
+    if isinstance(value, (int, float)):
+        return (0, value, '')
+    return (1, 0, value)
+
+
+class _Percentile(object):
+    # percentiles need all values of a group; other aggregates do not
+    def __init__(self, q):
+        self.q = q
+        self.values = []
+
+    def add(self, value):
+        if value is not None:
+            self.values.append(value)
+
+    def result(self):
+        if not self.values:
+            return None
+        values = sorted(self.values)
+        pos = (len(values) - 1) * self.q / 100.0
+        lower = int(pos)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (pos - lower)
+
+
+_aggregate_functions = {
+    'count': _Count,
+    'sum': _Sum,
+    'mean': _Mean,
+    'avg': _Mean,
+    'min': _Min,
+    'max': _Max,
+    'median': lambda: _Percentile(50),
+}
+_aggregate_re = re.compile(
+    r'^\s*(?P<func>\w+)\s*(?:\(\s*(?P<col>[^()\s]*)\s*\))?\s*$'
+)
+_percentile_re = re.compile(r'^p(?P<q>\d+(?:\.\d+)?)$')
+
+
+def _parse_aggregate(spec):
+    match = _aggregate_re.match(spec)
+    if match is None:
+        raise ItsdbError('Invalid aggregate: {}'.format(spec))
+    func, col = match.group('func').lower(), match.group('col') or None
+    percentile = _percentile_re.match(func)
+    if percentile is not None and float(percentile.group('q')) <= 100:
+        q = float(percentile.group('q'))
+        factory = lambda: _Percentile(q)
+    elif func in _aggregate_functions:
+        factory = _aggregate_functions[func]
+    else:
+        raise ItsdbError('Unknown aggregate function "{}" in: {}'
+                         .format(func, spec))
+    if col is None and func != 'count':
+        raise ItsdbError('Aggregate "{}" needs a column.'.format(spec))
+    numeric = func not in ('count', 'min', 'max')
+    return (col, factory, numeric)
+
+
+def aggregate_rows(rows, aggregates, group_by=None):
+    """
+    Compute aggregate statistics over `rows` in a single pass.
+
+    Aggregates are given as strings such as `count`, `count(COL)`,
+    `sum(COL)`, `mean(COL)` (or `avg`), `min(COL)`, `max(COL)`,
+    `median(COL)`, and percentiles like `p90(COL)`. `count` counts
+    rows, while `count(COL)` counts rows where COL is not None. Other
+    aggregates ignore None values and convert string values to
+    numbers, so they also work on untyped rows (though typed rows,
+    e.g. from ``read_table(typed=True)``, avoid the conversion); `min`
+    and `max` keep strings that are not numbers, and compare them
+    after all numbers. Only percentiles need to keep a group's values in
+    memory.
+
+    Args:
+        rows: an iterable of rows (dictionaries)
+        aggregates: an iterable of aggregate strings
+        group_by: the columns whose values define the groups; if None,
+            all rows are in one group
+    Returns:
+        A list of OrderedDicts, one per group in order of first
+        appearance, mapping each `group_by` column and each aggregate
+        string to its value.
+    """
+    aggregates = list(aggregates)
+    specs = [_parse_aggregate(agg) for agg in aggregates]
+    group_by = list(group_by or [])
+    groups = OrderedDict()
+    for row in rows:
+        group = tuple(row.get(col) for col in group_by)
+        states = groups.get(group)
+        if states is None:
+            states = groups[group] = [factory() for _, factory, _ in specs]
+        for (col, _, numeric), state in zip(specs, states):
+            if col is None:
+                state.add(True)
+                continue
+            value = row.get(col)
+            if numeric and isinstance(value, str):
+                value = _to_number(value)
+            state.add(value)
+    if not groups and not group_by:
+        groups[()] = [factory() for _, factory, _ in specs]
+    results = []
+    for group, states in groups.items():
+        result = OrderedDict(zip(group_by, group))
+        result.update(zip(aggregates, (state.result() for state in states)))
+        results.append(result)
+    return results
+
+
+def match_rows(rows1, rows2, key, sort_keys=True, presorted=False,
+               buffer_size=None):
     """
     Yield triples of (value, left_rows, right_rows) where `left_rows`
     and `right_rows` are lists of rows that share the same column
     value for `key`.
+
+    If `sort_keys` is True, triples are yielded in key order (integer
+    keys numerically, and before other keys) by merging the two row
+    streams, so only the rows for the current value are held in
+    memory. If `presorted` is True, the inputs must already be in key
+    order, as most [incr tsdb()] tables are, and they are merged
+    directly; otherwise each input is first sorted externally, holding
+    at most `buffer_size` rows in memory and spilling sorted runs to
+    temporary files. If `sort_keys` is False, triples are yielded in
+    the order values first appear, which holds all rows in memory.
+
+    Args:
+        rows1: the left rows
+        rows2: the right rows
+        key: the column to match rows on
+        sort_keys: if True, yield triples in key order
+        presorted: if True, the inputs are already in key order
+        buffer_size: the number of rows held in memory when sorting
+            unsorted inputs
+    Raises:
+        ItsdbError: when `presorted` is True but an input is not in
+            key order
     """
+    if not sort_keys:
+        for triple in _match_rows_unsorted(rows1, rows2, key):
+            yield triple
+        return
+    order = lambda value: (_key_order(value), value)
+    streams = []
+    for rows in (rows1, rows2):
+        if not presorted:
+            rows = _external_sort(rows, lambda row: order(row[key]),
+                                  buffer_size=buffer_size)
+        streams.append(_key_groups(rows, key, order, check=presorted))
+    left, right = streams
+    lgroup, rgroup = next(left, None), next(right, None)
+    while lgroup is not None or rgroup is not None:
+        if rgroup is None or (lgroup is not None and
+                              order(lgroup[0]) < order(rgroup[0])):
+            yield (lgroup[0], lgroup[1], [])
+            lgroup = next(left, None)
+        elif lgroup is None or order(rgroup[0]) < order(lgroup[0]):
+            yield (rgroup[0], [], rgroup[1])
+            rgroup = next(right, None)
+        else:
+            yield (lgroup[0], lgroup[1], rgroup[1])
+            lgroup, rgroup = next(left, None), next(right, None)
+
+
+def _match_rows_unsorted(rows1, rows2, key):
     matched = OrderedDict()
     for i, rows in enumerate([rows1, rows2]):
         for row in rows:
@@ -378,14 +891,64 @@ def match_rows(rows1, rows2, key, sort_keys=True):
                 matched[val] = ([], [])
                 data = matched[val]
             data[i].append(row)
-    vals = matched.keys()
-    if sort_keys:
-        vals = sorted(vals, key=safe_int)
-    for val in vals:
-        left, right = matched[val]
+    for val, (left, right) in matched.items():
         yield (val, left, right)
 
 
+def _key_groups(rows, key, order, check=False):
+    # Yield (value, rows) for runs of rows sharing a `key` value; with
+    # `check`, values must strictly increase from one run to the next.
+    prev = None
+    for value, group in groupby(rows, key=lambda row: row[key]):
+        if check:
+            current = order(value)
+            if prev is not None and current <= prev[0]:
+                raise ItsdbError(
+                    'Rows are not sorted by "{}": "{}" follows "{}".'
+                    .format(key, value, prev[1])
+                )
+            prev = (current, value)
+        yield (value, list(group))
+
+
+def _external_sort(rows, key, buffer_size=None):
+    """
+    Yield `rows` stably sorted by the function `key`. Inputs larger
+    than `buffer_size` rows are sorted in runs of that size which are
+    pickled to temporary files and merged.
+    """
+    if buffer_size is None:
+        buffer_size = _sort_buffer_size
+    rows = iter(rows)
+    runs = []
+    try:
+        while True:
+            buf = sorted(islice(rows, buffer_size), key=key)
+            if len(buf) < buffer_size:
+                break
+            run = tempfile.TemporaryFile()
+            pickler = pickle.Pickler(run, pickle.HIGHEST_PROTOCOL)
+            for row in buf:
+                pickler.dump(row)
+            run.seek(0)
+            runs.append(run)
+        streams = [_read_run(run) for run in runs] + [buf]
+        for row in heapq.merge(*streams, key=key):
+            yield row
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _read_run(f):
+    unpickler = pickle.Unpickler(f)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+
 def make_skeleton(path, relations, item_rows, gzip=False):
     """
     Instantiate a new profile skeleton (only the relations file and
@@ -417,6 +980,872 @@ def make_skeleton(path, relations, item_rows, gzip=False):
     return prof
 
 
+##############################################################################
+# Filter expressions
+
+_filter_token_re = re.compile(
+    r'\s*(?:'
+    r'(?P<num>-?\d+(?:\.\d+)?(?![\w-]))|'
+    r'(?P<str>"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\')|'
+    r'(?P<op>\.\.|==|!=|<=|>=|[=<>~(){},])|'
+    r'(?P<name>[A-Za-z_][\w-]*)'
+    r')'
+)
+_filter_comparisons = {
+    '=': '==', '==': '==', '!=': '!=',
+    '<': '<', '<=': '<=', '>': '>', '>=': '>='
+}
+
+
+def _to_int(x):
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_number(x):
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        try:
+            return float(x)
+        except (TypeError, ValueError):
+            return None
+
+
+def _to_str(x):
+    return None if x is None else str(x)
+
+
+class _FilterCompiler(object):
+    def __init__(self, expression, fields):
+        self.expression = expression
+        self.datatypes = None
+        if fields is not None:
+            self.datatypes = dict((f.name, f.datatype) for f in fields)
+        self.tokens = self._tokenize(expression)
+        self.pos = 0
+        self.env = {'_to_int': _to_int, '_to_number': _to_number,
+                    '_to_str': _to_str}
+        self.columns = []
+
+    def _tokenize(self, s):
+        tokens = []
+        pos = 0
+        s = s.rstrip()
+        while pos < len(s):
+            m = _filter_token_re.match(s, pos)
+            if m is None or m.end() == pos:
+                self.error('unexpected input at position {}'.format(pos))
+            kind = m.lastgroup
+            tokens.append((kind, m.group(kind)))
+            pos = m.end()
+        return tokens
+
+    def error(self, msg):
+        raise ItsdbError('Invalid filter expression "{}": {}'
+                         .format(self.expression, msg))
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self, kind=None, value=None):
+        tok = self.peek()
+        if ((kind is not None and tok[0] != kind) or
+                (value is not None and tok[1] != value)):
+            self.error('expected {} but got {}'
+                       .format(value or kind, tok[1] or 'end of input'))
+        self.pos += 1
+        return tok
+
+    def keyword(self, word):
+        tok = self.peek()
+        if tok[0] == 'name' and tok[1] == word:
+            self.pos += 1
+            return True
+        return False
+
+    def bind(self, obj):
+        name = '_v{}'.format(len(self.env))
+        self.env[name] = obj
+        return name
+
+    def compile(self):
+        source = self.disjunction()
+        if self.pos != len(self.tokens):
+            self.error('unexpected "{}"'.format(self.peek()[1]))
+        return source
+
+    def disjunction(self):
+        terms = [self.conjunction()]
+        while self.keyword('or'):
+            terms.append(self.conjunction())
+        return terms[0] if len(terms) == 1 else '({})'.format(
+            ' or '.join(terms))
+
+    def conjunction(self):
+        terms = [self.negation()]
+        while self.keyword('and'):
+            terms.append(self.negation())
+        return terms[0] if len(terms) == 1 else '({})'.format(
+            ' and '.join(terms))
+
+    def negation(self):
+        if self.keyword('not'):
+            return '(not {})'.format(self.negation())
+        return self.comparison()
+
+    def literal(self):
+        kind, value = self.next()
+        if kind == 'num':
+            return _to_number(value)
+        elif kind == 'str':
+            # interned so equality with interned row values is by identity
+            return sys.intern(re.sub(r'\\(.)', r'\1', value[1:-1]))
+        self.error('expected a number or string but got {}'
+                   .format(value or 'end of input'))
+
+    def column(self, name, literals, string=False):
+        if self.datatypes is not None and name not in self.datatypes:
+            self.error('column "{}" is not defined'.format(name))
+        if name not in self.columns:
+            self.columns.append(name)
+        datatype = (self.datatypes or {}).get(name)
+        if datatype == ':integer' and not string:
+            numbers = [lit if isinstance(lit, (int, float))
+                       else _to_number(lit) for lit in literals]
+            if any(num is None for num in numbers):
+                self.error('column "{}" only has integer values'
+                           .format(name))
+            if all(isinstance(num, int) or num.is_integer()
+                   for num in numbers):
+                conv = '_to_int'
+                literals[:] = [int(num) for num in numbers]
+            else:
+                # e.g. "readings < 0.5" must not become "readings < 0"
+                conv = '_to_number'
+                literals[:] = numbers
+        elif (not string and
+              all(isinstance(lit, (int, float)) for lit in literals)):
+            conv = '_to_number'
+        else:
+            conv = '_to_str'
+            literals[:] = [str(lit) for lit in literals]
+        return '{}(r.get({!r}))'.format(conv, name)
+
+    def comparison(self):
+        if self.peek() == ('op', '('):
+            self.next()
+            source = self.disjunction()
+            self.next('op', ')')
+            return source
+        name = self.next('name')[1]
+        kind, op = self.peek()
+        if op == '~':
+            self.next()
+            pattern = self.literal()
+            regex = self.bind(re.compile(str(pattern)))
+            col = self.column(name, [], string=True)
+            return '({0} is not None and {1}.search({0}) is not None)'.format(
+                col, regex)
+        elif kind == 'name' and op == 'in':
+            self.next()
+            if self.peek() == ('op', '{'):
+                self.next()
+                literals = [self.literal()]
+                while self.peek() == ('op', ','):
+                    self.next()
+                    literals.append(self.literal())
+                self.next('op', '}')
+                col = self.column(name, literals)
+                return '({} in {})'.format(col, self.bind(frozenset(literals)))
+            literals = [self.literal()]
+            self.next('op', '..')
+            literals.append(self.literal())
+            col = self.column(name, literals)
+            return ('({0} is not None and {1!r} <= {0} <= {2!r})'
+                    .format(col, literals[0], literals[1]))
+        elif op in _filter_comparisons:
+            self.next()
+            literals = [self.literal()]
+            col = self.column(name, literals)
+            return '({0} is not None and {0} {1} {2!r})'.format(
+                col, _filter_comparisons[op], literals[0])
+        self.error('expected a comparison after "{}"'.format(name))
+
+
+def compile_filter(expression, fields=None):
+    """
+    Compile a declarative filter expression into a filter function
+    (see :py:func:`filter_rows`). Expressions are made of comparisons
+    on column values combined with `and`, `or`, `not`, and
+    parentheses::
+
+        readings > 0
+        i-wf = 1 and i-length in 1..10
+        i-input ~ "^The "
+        i-id in {10, 20, 30} or not (i-wf != 1)
+
+    Comparison operators are `=` (or `==`), `!=`, `<`, `<=`, `>`,
+    `>=`, `~` (regular expression search), `in LOW..HIGH` (inclusive
+    range), and `in {V1, V2, ..}` (set membership). Values are numbers
+    or quoted strings. Columns with the `:integer` datatype in
+    `fields` are compared as integers (or as numbers when compared
+    with a non-integer value); other columns are compared as numbers
+    if all compared values are numbers, otherwise as strings.
+    Rows with missing or unconvertible values never match a
+    comparison.
+
+    The whole expression is compiled into a single Python function,
+    so filtering does not make a function call per comparison.
+
+    Args:
+        expression: the filter expression
+        fields: an iterable of :py:class:`Field` objects used to check
+            column names and determine datatypes
+    Returns:
+        A filter function `f(row, x)`; it has a `columns` attribute
+        listing the columns it uses and an `expression` attribute with
+        the original expression.
+    Raises:
+        ItsdbError if the expression is invalid.
+    """
+    compiler = _FilterCompiler(expression, fields)
+    source = compiler.compile()
+    function = eval('lambda r, x: {}'.format(source), compiler.env)
+    function.expression = expression
+    function.columns = compiler.columns
+    return function
+
+
+def _profile_cache_dir(root):
+    """
+    Return a directory for derived data (decompressed tables, indices,
+    etc.) for the profile at `root`. The directory is in the user's
+    cache directory (`$XDG_CACHE_HOME` or `~/.cache`) so profiles are
+    never written to when they are only read, and falls back to the
+    system's temporary directory if the user's cache is not writable.
+    """
+    digest = hashlib.md5(
+        os.path.abspath(root).encode('utf-8')
+    ).hexdigest()
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    path = os.path.join(cache_home, _cache_dirname, digest)
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+    except OSError:
+        path = None
+    if path is None or not os.access(path, os.W_OK):
+        try:
+            user = getpass.getuser()
+        except Exception:
+            user = 'unknown'
+        path = os.path.join(tempfile.gettempdir(),
+                            '{}-{}'.format(_cache_dirname, user), digest)
+        os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def _write_key_offsets(path, stamp, offsets):
+    """
+    Write the key offsets `offsets` stamped with `stamp` to `path`. The
+    file is a single line of JSON (the stamp, the key values, and the
+    number of offsets for each) followed by the offsets as raw 64-bit
+    integers, so loading it never executes code.
+    """
+    values = list(offsets)
+    header = {
+        'version': _key_index_version,
+        'byteorder': sys.byteorder,
+        'stamp': list(stamp),
+        'values': values,
+        'counts': [len(offsets[value]) for value in values]
+    }
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(json.dumps(header).encode('utf-8') + b'\n')
+        for value in values:
+            offsets[value].tofile(f)
+    os.replace(tmp_path, path)
+
+
+def _read_key_offsets(path, stamp):
+    """
+    Return the key offsets written by :py:func:`_write_key_offsets` to
+    `path`, or None if the file does not exist, is malformed, or its
+    stamp does not match `stamp`.
+    """
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if (header.get('version') != _key_index_version or
+                    header.get('byteorder') != sys.byteorder or
+                    header.get('stamp') != list(stamp)):
+                return None
+            values, counts = header['values'], header['counts']
+            data = array('q')
+            data.fromfile(f, sum(counts))
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, ValueError, TypeError, KeyError,
+            AttributeError):
+        logging.warning('Could not read the key index at {}; '
+                        'rebuilding it.'.format(path))
+        return None
+    offsets = {}
+    start = 0
+    for value, count in zip(values, counts):
+        offsets[value] = data[start:start + count]
+        start += count
+    return offsets
+
+
+def _scan_key_offsets(path, col):
+    """
+    Return a dictionary mapping the values of the `col`-th field of the
+    table at `path` to arrays of the byte offsets of their rows.
+    """
+    offsets = {}
+    delim = _field_delimiter.encode('utf-8')
+    opener = gzopen if path.endswith('.gz') else open
+    pos = 0
+    with opener(path, 'rb') as f:
+        for line in f:
+            fields = line.strip().split(delim)
+            if col < len(fields):
+                value = fields[col].decode('utf-8')
+                if '\\' in value:
+                    value = unescape(value)
+                if value not in offsets:
+                    offsets[value] = array('q')
+                offsets[value].append(pos)
+            pos += len(line)
+    return offsets
+
+
+def _decode_lines(f):
+    with f:
+        for fields in decode_rows(f):
+            yield fields
+
+
+def _intersect_sorted(offsets, others):
+    """
+    Yield the values of the sorted iterable `offsets` that are also in
+    the sorted sequence `others`, without building a set of either.
+    """
+    i, n = 0, len(others)
+    for offset in offsets:
+        while i < n and others[i] < offset:
+            i += 1
+        if i == n:
+            return
+        if others[i] == offset:
+            yield offset
+
+
+def _any_sorted(offsets, others):
+    """
+    Return True if any value of `offsets` is in the sorted sequence
+    `others`.
+    """
+    n = len(others)
+    for offset in offsets:
+        i = bisect_left(others, offset)
+        if i < n and others[i] == offset:
+            return True
+    return False
+
+
+def _chunk_ranges(path, chunk_size):
+    """
+    Return (start, end) byte ranges covering the file at `path` such
+    that each range is about `chunk_size` bytes and ends on a line
+    boundary.
+    """
+    ranges = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        start = 0
+        while start < size:
+            f.seek(min(start + chunk_size, size))
+            f.readline()  # finish the current line
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def _scan_chunk(task):
+    # Return the byte offsets of the rows in one chunk of a table that
+    # pass all filter `expressions`; only the filtered columns are
+    # unescaped and only the offsets are sent back to the parent.
+    path, start, end, fields, expressions = task
+    functions = [compile_filter(expression, table_fields)
+                 for expression, table_fields in expressions]
+    columns = [(i, f.name) for i, f in enumerate(fields)
+               if any(f.name in function.columns for function in functions)]
+    delimiter = _field_delimiter.encode('utf-8')
+    offsets = array('q')
+    pos = start
+    with open(path, 'rb') as f:
+        f.seek(start)
+        lines = f.read(end - start).split(b'\n')
+    if lines[-1] == b'':
+        lines.pop()  # the final newline does not start a new row
+    for line in lines:
+        values = line.strip().split(delimiter)
+        row = {}
+        for i, name in columns:
+            if i < len(values):
+                value = values[i].decode('utf-8')
+                row[name] = unescape(value) if '\\' in value else value
+        if all(function(row, None) for function in functions):
+            offsets.append(pos)
+        pos += len(line) + 1
+    return offsets
+
+
+def _scan_chunks_parallel(path, fields, expressions, workers,
+                          chunk_size=None):
+    """
+    Yield the byte offsets, in order, of the rows of the table at
+    `path` that pass the compiled filter `expressions` (pairs of an
+    expression and the fields it was compiled with), with chunks of
+    the file scanned by `workers` processes. At most two chunks per
+    worker are in flight at a time.
+    """
+    tasks = ((path, start, end, fields, expressions) for start, end
+             in _chunk_ranges(path, chunk_size or _chunk_size))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for task in tasks:
+            pending.append(executor.submit(_scan_chunk, task))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            offsets = pending.pop(0).result()
+            task = next(tasks, None)
+            if task is not None:
+                pending.append(executor.submit(_scan_chunk, task))
+            for offset in offsets:
+                yield offset
+
+
+def _smallest_typecode(typecodes, low, high):
+    # the first array typecode in `typecodes` that can hold low..high
+    for typecode in typecodes:
+        bits = array(typecode).itemsize * 8
+        if typecode.isupper():
+            lower, upper = 0, 2 ** bits - 1
+        else:
+            lower, upper = -2 ** (bits - 1), 2 ** (bits - 1) - 1
+        if lower <= low and high <= upper:
+            return typecode
+    return None
+
+
+class _ColumnStats(object):
+    """
+    Statistics over the raw (escaped) values of one column, used to
+    choose the column's encoding in a columnar cache: integers that
+    print back identically go in the smallest array type that holds
+    them, columns are dictionary-encoded only when the vocabulary plus
+    codes is smaller than the text, and other columns are kept as
+    escaped text with one value per line.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.ints = True
+        self.low = self.high = 0
+        self.text_size = 0
+        self.vocab = OrderedDict()  # None once there are too many values
+        self.vocab_size = 0
+
+    def add(self, value):
+        self.count += 1
+        self.text_size += len(value) + 1
+        if self.ints:
+            try:
+                i = int(value)
+            except ValueError:
+                self.ints = False
+            else:
+                if str(i) != value:
+                    self.ints = False
+                else:
+                    self.low = min(self.low, i)
+                    self.high = max(self.high, i)
+        vocab = self.vocab
+        if vocab is not None and value not in vocab:
+            if len(vocab) >= _intern_limit:
+                self.vocab = None
+            else:
+                vocab[value] = len(vocab)
+                self.vocab_size += len(value) + 1
+
+    def encoding(self):
+        """
+        Return the (kind, typecode) encoding for the column.
+        """
+        if self.ints:
+            typecode = _smallest_typecode('bhiq', self.low, self.high)
+            if typecode is not None:
+                return ('int', typecode)
+        if self.vocab is not None:
+            typecode = _smallest_typecode('BHIL', 0, len(self.vocab))
+            size = self.vocab_size + self.count * array(typecode).itemsize
+            if size < self.text_size:
+                return ('dict', typecode)
+        return ('str', None)
+
+
+def _write_column_block(f, column, values):
+    """
+    Append the raw (escaped) `values` to the open column file `f`
+    encoded as described by the cache metadata `column`.
+    """
+    kind = column['kind']
+    if kind == 'int':
+        array(column['typecode'], map(int, values)).tofile(f)
+    elif kind == 'dict':
+        vocab = column['codes']
+        array(column['typecode'], [vocab[v] for v in values]).tofile(f)
+    else:
+        f.write(''.join(v + '\n' for v in values))
+
+
+def _read_column_block(f, column, count, typed=False):
+    """
+    Return the next `count` decoded values from the open column file
+    `f` described by the cache metadata `column`. Integer columns give
+    `int` values if `typed` is True, and strings otherwise.
+    """
+    kind = column['kind']
+    if kind == 'str':
+        _unescape = unescape
+        return [_unescape(line[:-1]) if '\\' in line else line[:-1]
+                for line in islice(f, count)]
+    data = array(column['typecode'])
+    try:
+        data.fromfile(f, count)
+    except EOFError:
+        pass  # the caller notices the short block
+    if kind == 'int':
+        return data.tolist() if typed else list(map(str, data))
+    vocab = column['vocab']
+    return [vocab[code] for code in data]
+
+
+class _InternPool(object):
+    """
+    Per-column dictionaries of decoded values, so repeated values in
+    a column share one string object. Columns whose number of distinct
+    values exceeds `limit` (e.g. sentences or MRSs) stop being
+    interned and their dictionaries are dropped.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit or _intern_limit
+        self._pools = {}
+
+    def intern_rows(self, table, columns, rows):
+        """
+        Yield each row of decoded values in `rows` with the values at
+        the `columns` positions replaced by their interned versions.
+        """
+        pools = []
+        for i in columns:
+            pool = self._pools.setdefault((table, i), {})
+            if pool is not None:
+                pools.append((i, pool))
+        limit = self.limit
+        for fields in rows:
+            dropped = False
+            for i, pool in pools:
+                if i < len(fields):
+                    value = fields[i]
+                    interned = pool.get(value)
+                    if interned is None:
+                        if len(pool) >= limit:
+                            # too many distinct values; stop interning
+                            self._pools[(table, i)] = None
+                            dropped = True
+                            continue
+                        interned = pool[value] = sys.intern(value)
+                    fields[i] = interned
+            if dropped:
+                pools = [(i, pool) for i, pool in pools
+                         if self._pools[(table, i)] is not None]
+            yield fields
+
+
+def _file_stamp(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size)
+
+
+def _has_stamp(path, stamp):
+    """
+    Return True if `path` exists and was stamped (see
+    :py:func:`_write_stamp`) with `stamp`.
+    """
+    try:
+        with open(path + '.stamp') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return cached == list(stamp) and os.path.exists(path)
+
+
+def _write_stamp(path, stamp):
+    with open(path + '.stamp', 'w') as f:
+        json.dump(list(stamp), f)
+
+
+class _MappedTable(object):
+    """
+    A memory-mapped table file with the byte offset of each row
+    recorded in a single scan. Rows are only decoded when accessed,
+    either one at a time (see :py:class:`ColumnView`) or in bulk with
+    :py:meth:`rows`. The table must be closed when it is no longer
+    needed, either with :py:meth:`close` or by using it as a context
+    manager.
+    """
+
+    _block_size = 4096  # rows decoded at a time by rows()
+
+    def __init__(self, path, field_names):
+        self.path = path
+        self.field_names = field_names
+        self._offsets = array('q')
+        self._last = (None, None)  # the most recently decoded row
+        self._file = open(path, 'rb')
+        try:
+            if os.fstat(self._file.fileno()).st_size == 0:
+                self._mm = b''
+            else:
+                self._mm = mmap.mmap(self._file.fileno(), 0,
+                                     access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            self._file.close()
+            raise
+        self._scan()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _scan(self):
+        mm = self._mm
+        offsets = self._offsets
+        find = mm.find
+        pos = 0
+        size = len(mm)
+        while pos < size:
+            offsets.append(pos)
+            end = find(b'\n', pos)
+            if end == -1:
+                break
+            pos = end + 1
+        # the final offset marks the end of the last row
+        offsets.append(size)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def _align(self, fields):
+        field_len = len(self.field_names)
+        if len(fields) != field_len:
+            logging.error('Number of stored fields ({}) '
+                          'differ from the expected number({}); '
+                          'fields may be misaligned!'
+                          .format(len(fields), field_len))
+            # missing fields become empty values
+            fields = fields[:field_len]
+            fields.extend([''] * (field_len - len(fields)))
+        return fields
+
+    def row(self, i):
+        """
+        Return the decoded fields of the `i`-th row.
+        """
+        if self._last[0] == i:
+            return self._last[1]
+        offsets = self._offsets
+        line = self._mm[offsets[i]:offsets[i + 1]].decode('utf-8')
+        fields = self._align(decode_row(line))
+        self._last = (i, fields)
+        return fields
+
+    def rows(self, start=0, stop=None, cols=None):
+        """
+        Yield the decoded fields of the rows from `start` up to `stop`.
+        Rows are sliced from the map and decoded in blocks. If `cols`
+        is given, only the fields at those positions are yielded (and
+        unescaped).
+        """
+        if stop is None or stop > len(self):
+            stop = len(self)
+        mm, offsets, align = self._mm, self._offsets, self._align
+        field_len = len(self.field_names)
+        delimiter = _field_delimiter
+        _unescape = unescape
+        for i in range(start, stop, self._block_size):
+            j = min(i + self._block_size, stop)
+            data = mm[offsets[i]:offsets[j]].decode('utf-8')
+            escaped = '\\' in data
+            for line in data.split('\n')[:j - i]:
+                fields = line.strip().split(delimiter)
+                if len(fields) != field_len:
+                    fields = align(fields)
+                if cols is not None:
+                    fields = [fields[k] for k in cols]
+                if escaped and '\\' in line:
+                    fields = [_unescape(f) if '\\' in f else f
+                              for f in fields]
+                yield fields
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+
+class ColumnViews(OrderedDict):
+    """
+    An ordered mapping of column names to :py:class:`ColumnView`
+    objects over one memory-mapped table, as returned by
+    :py:meth:`ItsdbProfile.read_columns`. The table stays mapped until
+    :py:meth:`close` is called or, when used as a context manager, the
+    `with` block is exited; the views cannot be read afterwards.
+    """
+
+    def __init__(self, table, views):
+        OrderedDict.__init__(self, views)
+        self._table = table
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._table.closed
+
+    def close(self):
+        """
+        Close the memory-mapped table underlying the views.
+        """
+        self._table.close()
+
+
+class ColumnView(object):
+    """
+    A lazily-decoded, read-only sequence of the values of one column
+    of a table. Values are decoded from the memory-mapped table each
+    time they are accessed, so views are cheap to create and hold.
+    Views are obtained from :py:meth:`ItsdbProfile.read_columns`.
+    If the view has a `converter` (e.g. for typed reads), it is applied
+    to each decoded value.
+    """
+
+    def __init__(self, table, name, converter=None):
+        self._table = table
+        self.name = name
+        self._col = table.field_names.index(name)
+        self.converter = converter
+
+    def __len__(self):
+        return len(self._table)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return list(self._values(start, stop))
+            return [self[j] for j in range(start, stop, step)]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('column index out of range')
+        value = self._table.row(i)[self._col]
+        if self.converter is not None:
+            value = self.converter(value)
+        return value
+
+    def __iter__(self):
+        return self._values(0, len(self._table))
+
+    def _values(self, start, stop):
+        col = self._col
+        values = (fields[col] for fields in self._table.rows(start, stop))
+        if self.converter is not None:
+            values = map(self.converter, values)
+        return values
+
+    def __repr__(self):
+        return '<ColumnView {} ({} rows)>'.format(self.name, len(self))
+
+
+def _key_order(value):
+    # sort integer-like keys numerically, and before any others;
+    # composite (tuple) keys sort by their parts, after all others
+    if isinstance(value, tuple):
+        return (2, 0, tuple(map(_key_order, value)))
+    value = safe_int(value)
+    if isinstance(value, int):
+        return (0, value, '')
+    return (1, 0, value)
+
+
+class _MergeCursor(object):
+    """
+    Look up the rows of a key-sorted stream of rows by key value,
+    reading the stream forward as long as lookups are in key order.
+    Lookups for keys before the current position use `fallback`.
+    """
+
+    def __init__(self, rows, key, fallback):
+        self._rows = iter(rows)
+        self._key = key
+        self._fallback = fallback
+        self._order = None
+        self._group = []
+        self._next = next(self._rows, None)
+
+    def lookup(self, value):
+        key, order = self._key, _key_order(value)
+        if self._order is not None:
+            if order == self._order:
+                return self._group
+            if order < self._order:
+                return self._fallback(value)
+        while (self._next is not None and
+               _key_order(self._next[key]) < order):
+            self._next = next(self._rows, None)
+        group = []
+        while (self._next is not None and
+               _key_order(self._next[key]) == order):
+            group.append(self._next)
+            self._next = next(self._rows, None)
+        self._order, self._group = order, group
+        return group
+
+
 ##############################################################################
 # Profile class
 
@@ -425,7 +1854,8 @@ class ItsdbProfile:
     A [incr tsdb()] profile, analyzed and ready for reading or writing.
     """
 
-    def __init__(self, path, filters=None, applicators=None, index=True):
+    def __init__(self, path, filters=None, applicators=None, index=True,
+                 use_cache=True, intern=False):
         """
         Only the `path` parameter is required.
 
@@ -442,7 +1872,23 @@ class ItsdbProfile:
                 pair will be applied in order. Applicators apply after
                 the filters.
             index: If True, indices are created based on the keys of
-                each table.
+                each table. Indices are built the first time they are
+                needed (so filters added before the first query are
+                included), and the key positions they are computed from
+                are persisted in a cache directory (see
+                :py:meth:`key_offsets`) so later opens avoid rescanning
+                unfiltered tables.
+            use_cache: If True, read tables from their columnar cache
+                when it is fresh (see :py:meth:`export_columnar`).
+            intern: If True, values decoded from columns of the
+                `:string`, `:integer`, and `:date` datatypes are
+                interned in per-column dictionaries, so repeated values
+                (e.g. `i-origin`, `readings`, rule names) share one
+                string object across all rows read by this profile;
+                a collection of datatypes selects which columns are
+                interned. Columns with too many distinct values stop
+                being interned. Dictionary-encoded columns of the
+                columnar cache are shared without this option.
         """
 
         self.root = path
@@ -452,7 +1898,15 @@ class ItsdbProfile:
 
         self.filters = defaultdict(list)
         self.applicators = defaultdict(list)
-        self._index = dict()
+        self._index = None if index else dict()
+        self._key_offsets = dict()
+        self._row_filters = dict()
+        self._converters = dict()
+        self.use_cache = use_cache
+        if intern is True:
+            intern = _interned_datatypes
+        self.interned_datatypes = set(intern or [])
+        self._intern_pool = _InternPool()
 
         for (table, cols, condition) in (filters or []):
             self.add_filter(table, cols, condition)
@@ -460,18 +1914,22 @@ class ItsdbProfile:
         for (table, cols, function) in (applicators or []):
             self.add_applicator(table, cols, function)
 
-        if index:
-            self._build_index()
-
     def add_filter(self, table, cols, condition):
         """
         Add a filter. When reading `table`, rows in `table` will be
         filtered by :py:func:`filter_rows`.
 
+        If `condition` is a string, it is compiled as a filter
+        expression by :py:func:`compile_filter` (using the datatypes of
+        `table`), and it is fused with a directly preceding compiled
+        filter on the same table so both are tested with a single
+        function call. Compiled filters are tested once per row,
+        whatever `cols` are given.
+
         Args:
             table: The table the filter applies to.
             cols: The columns in `table` to filter on.
-            condition: The filter function.
+            condition: The filter function or expression.
         """
         if table is not None and table not in self.relations:
             raise ItsdbError('Cannot add filter; table "{}" is not defined '
@@ -480,7 +1938,19 @@ class ItsdbProfile:
         # this is a hack, though perhaps well-motivated
         if cols is None:
             cols = [None]
-        self.filters[table].append((cols, condition))
+        filters = self.filters[table]
+        if isinstance(condition, str) or hasattr(condition, 'expression'):
+            # compiled filters read the columns they need from the row,
+            # so they run once per row rather than once per column
+            cols = [None]
+        if isinstance(condition, str):
+            fields = self.relations[table] if table is not None else None
+            if (filters and filters[-1][0] == cols and
+                    hasattr(filters[-1][1], 'expression')):
+                condition = '({}) and ({})'.format(
+                    filters.pop()[1].expression, condition)
+            condition = compile_filter(condition, fields)
+        filters.append((cols, condition))
 
     def add_applicator(self, table, cols, function):
         """
@@ -507,15 +1977,124 @@ class ItsdbProfile:
                                  .format(col))
         self.applicators[table].append((cols, function))
 
+    def _key_sets(self):
+        if self._index is None:
+            self._build_index()
+        return self._index
+
     def _build_index(self):
         self._index = {key: None for key, _ in _primary_keys}
         for (keyname, table) in _primary_keys:
-            ids = set()
-            for row in self.read_table(table):
-                key = row[keyname]
-                ids.add(key)
+            if self.filters[None] or self.filters[table]:
+                ids = set()
+                for row in self.read_table(table):
+                    key = row[keyname]
+                    ids.add(key)
+            else:
+                ids = self._cascade_keys(table, keyname)
             self._index[keyname] = ids
 
+    def _cascade_keys(self, table, keyname):
+        # Without filters on `table`, the key filter only depends on the
+        # other key columns, so compute it from the cached key offsets
+        # instead of reading the table.
+        checks = [(f.name, self._index[f.name])
+                  for f in self.relations[table]
+                  if f.key and f.name != keyname and
+                  self._index.get(f.name) is not None]
+        allowed = self._key_row_offsets(table, checks)
+        key_offsets = self.key_offsets(table, keyname)
+        if allowed is None:
+            return set(key_offsets)
+        return set(value for value, offs in key_offsets.items()
+                   if _any_sorted(offs, allowed))
+
+    def _key_row_offsets(self, table, checks):
+        # Intersect, over the (column, key set) pairs in `checks`, the
+        # sorted byte offsets of rows whose key is in the set. Columns
+        # where every value passes are skipped, and None means no row
+        # is excluded at all. Offsets stay in arrays (8 bytes each)
+        # rather than sets of Python ints.
+        allowed = None
+        for col, ids in checks:
+            offsets = self.key_offsets(table, col)
+            values = offsets.keys() & ids
+            if len(values) == len(offsets):
+                continue
+            # each value's offsets are sorted, so they only need merging
+            rows = heapq.merge(*[offsets[value] for value in values])
+            if allowed is not None:
+                rows = _intersect_sorted(rows, allowed)
+            allowed = array('q', rows)
+        return allowed
+
+    def _allowed_rows(self, table):
+        # The sorted byte offsets of the rows in `table` that pass the
+        # key filter, or None if every row passes. The result is
+        # computed once per set of key sets and table file.
+        index = self._key_sets()
+        checks = [(f.name, index[f.name]) for f in self.relations[table]
+                  if f.key and index.get(f.name) is not None]
+        if not checks:
+            return None
+        stamp = _file_stamp(self._table_source(table))
+        cached = self._row_filters.get(table)
+        if (cached is not None and cached[0] == stamp and
+                len(cached[1]) == len(checks) and
+                all(a is b for (_, a), (_, b) in zip(cached[1], checks))):
+            return cached[2]
+        allowed = self._key_row_offsets(table, checks)
+        self._row_filters[table] = (stamp, checks, allowed)
+        return allowed
+
+    def _table_source(self, table):
+        tbl_filename = os.path.join(self.root, table)
+        if os.path.exists(tbl_filename):
+            return tbl_filename
+        elif os.path.exists(tbl_filename + '.gz'):
+            return tbl_filename + '.gz'
+        raise ItsdbError(
+            'Table {} does not exist at {}(.gz)'
+            .format(table, tbl_filename)
+        )
+
+    def key_offsets(self, table, col):
+        """
+        Return a dictionary mapping each value of `col` in `table` to
+        an array of the byte offsets of the rows with that value.
+
+        Offsets are for the uncompressed table data (for gzipped tables
+        this is the decompressed cache used by :py:meth:`read_columns`).
+        The mapping is built on first use and persisted in the user's
+        cache directory; it is reused (also by other processes) as long
+        as the table file's modification time and size are unchanged.
+        """
+        if (table, col) in self._key_offsets:
+            return self._key_offsets[(table, col)]
+        fields = [f.name for f in self.table_relations(table)]
+        if col not in fields:
+            raise ItsdbError('Column "{}" not defined for table "{}".'
+                             .format(col, table))
+        source = self._table_source(table)
+        stamp = _file_stamp(source)
+        idx_filename = self._key_index_filename(table, col)
+        offsets = _read_key_offsets(idx_filename, stamp)
+        if offsets is None:
+            offsets = _scan_key_offsets(source, fields.index(col))
+            self._save_key_offsets(table, col, offsets, stamp=stamp)
+        self._key_offsets[(table, col)] = offsets
+        return offsets
+
+    def _key_index_filename(self, table, col):
+        return os.path.join(_profile_cache_dir(self.root),
+                            '{}.{}.idx'.format(table, col))
+
+    def _save_key_offsets(self, table, col, offsets, stamp=None):
+        if stamp is None:
+            stamp = _file_stamp(self._table_source(table))
+        _write_key_offsets(self._key_index_filename(table, col),
+                           stamp, offsets)
+
     def table_relations(self, table):
         if table not in self.relations:
             raise ItsdbError(
@@ -532,11 +2111,12 @@ class ItsdbProfile:
                             'were found; attempting to use the plaintext one.'
                             .format(table))
         if os.path.exists(tbl_filename):
-            f = open(tbl_filename)
+            f = open(tbl_filename, buffering=_io_buffer_size)
         elif os.path.exists(gz_filename):
             # text mode only from py3.3; until then use TextIOWrapper
             f = TextIOWrapper(
-                BufferedReader(gzopen(tbl_filename + '.gz', mode='r'))
+                BufferedReader(gzopen(tbl_filename + '.gz', mode='r'),
+                               buffer_size=_io_buffer_size)
             )
         else:
             raise ItsdbError(
@@ -545,59 +2125,542 @@ class ItsdbProfile:
             )
         return f
 
-    def read_raw_table(self, table):
+    def _columnar_filename(self, table):
+        return os.path.join(_profile_cache_dir(self.root),
+                            '{}.columns'.format(table))
+
+    def _columnar_cache(self, table):
+        # the metadata of a fresh columnar cache of `table`, or None
+        filename = os.path.join(self._columnar_filename(table), 'meta.json')
+        try:
+            with open(filename) as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning('Could not read the columnar cache at {}.'
+                            .format(filename))
+            return None
+        fields = [f.name for f in self.table_relations(table)]
+        if (not isinstance(meta, dict) or
+                meta.get('version') != _columnar_cache_version or
+                meta.get('byteorder') != sys.byteorder or
+                meta.get('fields') != fields or
+                meta.get('stamp') !=
+                list(_file_stamp(self._table_source(table)))):
+            return None
+        return meta
+
+    def _read_columnar(self, table, meta, typed=False):
+        # yield lists of values from the columnar cache of `table`,
+        # reading a block of rows from each column file at a time
+        path = self._columnar_filename(table)
+        columns = [dict(column) for column in meta['columns']]
+        files = []
+        try:
+            for i, column in enumerate(columns):
+                filename = os.path.join(path, '{}.col'.format(i))
+                if column['kind'] == 'str':
+                    files.append(open(filename, encoding='utf-8',
+                                      newline='\n'))
+                else:
+                    files.append(open(filename, 'rb'))
+                if column['kind'] == 'dict':
+                    vocab_filename = os.path.join(path, '{}.vocab'.format(i))
+                    with open(vocab_filename, encoding='utf-8',
+                              newline='\n') as f:
+                        column['vocab'] = [unescape(line[:-1]) for line in f]
+            remaining = meta['rows']
+            while remaining > 0:
+                count = min(remaining, _columnar_block_size)
+                block = [_read_column_block(f, column, count, typed)
+                         for f, column in zip(files, columns)]
+                if any(len(values) != count for values in block):
+                    raise ItsdbError('The columnar cache at {} is truncated.'
+                                     .format(path))
+                for values in zip(*block):
+                    yield list(values)
+                remaining -= count
+        finally:
+            for f in files:
+                f.close()
+
+    def export_columnar(self, tables=None):
+        """
+        Write a binary columnar cache of each table. Each column is
+        written to its own file: integer columns as arrays of the
+        smallest integer type that holds them, columns whose values
+        repeat enough that a vocabulary plus codes is smaller than the
+        text as dictionary-encoded arrays, and other columns as
+        escaped text with one value per line. The cache is stamped
+        with the modification time and size of the text table. While
+        the stamp matches, :py:meth:`read_raw_table` (and so all
+        row-based queries) read the cache, a block of rows at a time,
+        instead of decoding the text table; once the table changes, the
+        cache is ignored until it is exported again. Tables with
+        misaligned rows are not exported.
+
+        Args:
+            tables: The tables to export; if None, all existing tables
+        Returns:
+            The list of tables that were exported
+        """
+        if tables is None:
+            tables = [t for t in self.relations
+                      if os.path.exists(os.path.join(self.root, t)) or
+                      os.path.exists(os.path.join(self.root, t + '.gz'))]
+        exported = []
+        for table in tables:
+            fields = [f.name for f in self.table_relations(table)]
+            stamp = _file_stamp(self._table_source(table))
+            # the first pass chooses the encoding of each column
+            stats = [_ColumnStats() for _ in fields]
+            with self._open_table(table) as tbl:
+                for line in tbl:
+                    row = line.strip().split(_field_delimiter)
+                    if len(row) != len(fields):
+                        logging.warning('Not exporting table {}; it has '
+                                        'misaligned rows.'.format(table))
+                        stats = None
+                        break
+                    for column, value in zip(stats, row):
+                        column.add(value)
+            if stats is None:
+                continue
+            columns = []
+            for column in stats:
+                kind, typecode = column.encoding()
+                columns.append({'kind': kind, 'typecode': typecode})
+            path = self._columnar_filename(table)
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            os.makedirs(tmp_path)
+            try:
+                self._write_columnar(table, tmp_path, columns, stats)
+                meta = {
+                    'version': _columnar_cache_version,
+                    'byteorder': sys.byteorder,
+                    'stamp': list(stamp),
+                    'fields': fields,
+                    'rows': stats[0].count if stats else 0,
+                    'columns': columns
+                }
+                with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+                    json.dump(meta, f)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(tmp_path, path)
+            except Exception:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+            exported.append(table)
+        return exported
+
+    def _write_columnar(self, table, path, columns, stats):
+        # the second pass writes the raw values of each column to its
+        # file a block of rows at a time
+        files = []
+        try:
+            for i, (column, column_stats) in enumerate(zip(columns, stats)):
+                filename = os.path.join(path, '{}.col'.format(i))
+                if column['kind'] == 'str':
+                    files.append(open(filename, 'w', encoding='utf-8',
+                                      newline='\n'))
+                    continue
+                files.append(open(filename, 'wb'))
+                if column['kind'] == 'dict':
+                    vocab_filename = os.path.join(path, '{}.vocab'.format(i))
+                    with open(vocab_filename, 'w', encoding='utf-8',
+                              newline='\n') as f:
+                        f.write(''.join(v + '\n' for v in column_stats.vocab))
+            writers = [dict(column, codes=column_stats.vocab)
+                       for column, column_stats in zip(columns, stats)]
+            with self._open_table(table) as tbl:
+                rows = (line.strip().split(_field_delimiter) for line in tbl)
+                while True:
+                    block = list(islice(rows, _columnar_block_size))
+                    if not block:
+                        break
+                    for f, column, values in zip(files, writers,
+                                                 zip(*block)):
+                        _write_column_block(f, column, values)
+        finally:
+            for f in files:
+                f.close()
+
+    def _uncompressed_table(self, table):
+        path = self._table_source(table)
+        if path.endswith('.gz'):
+            # random access needs an uncompressed file, so decompress
+            # into the cache; the copy is stamped with the modification
+            # time and size of the gzipped file so it is rebuilt when
+            # that file is replaced, even by an older one
+            gz_filename = path
+            stamp = _file_stamp(gz_filename)
+            path = os.path.join(_profile_cache_dir(self.root), table)
+            if not _has_stamp(path, stamp):
+                tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+                with gzopen(gz_filename, mode='rb') as src, \
+                        open(tmp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.replace(tmp_path, path)
+                _write_stamp(path, stamp)
+        return path
+
+    def _mapped_table(self, table):
+        path = self._uncompressed_table(table)
+        field_names = [f.name for f in self.table_relations(table)]
+        return _MappedTable(path, field_names)
+
+    def _table_converters(self, table):
+        # (column, converter) pairs for columns with non-string datatypes
+        if table not in self._converters:
+            self._converters[table] = [
+                (f.name, _datatype_converters[f.datatype])
+                for f in self.table_relations(table)
+                if f.datatype in _datatype_converters
+            ]
+        return self._converters[table]
+
+    def read_columns(self, table, cols=None, typed=False):
+        """
+        Return lazily-decoded column views over the [incr tsdb()]
+        `table`. The table file is memory-mapped (gzipped tables are
+        first decompressed into a cache) and scanned once for field
+        offsets; values are only decoded when accessed. No filters,
+        applicators, or key filters are used.
+
+        Args:
+            table: The name of the table to read
+            cols: The columns to get views for; if None, all columns
+            typed: If True, values are converted according to the
+                column datatypes (see :py:func:`typed_value`)
+        Returns:
+            A :py:class:`ColumnViews` mapping of column names to
+            :py:class:`ColumnView` objects; close it (or use it as a
+            context manager) to release the table.
+        """
+        field_names = [f.name for f in self.table_relations(table)]
+        if cols is None:
+            cols = field_names
+        for col in cols:
+            if col not in field_names:
+                raise ItsdbError('Column "{}" not defined for table "{}".'
+                                 .format(col, table))
+        mapped = self._mapped_table(table)
+        converters = dict(self._table_converters(table)) if typed else {}
+        return ColumnViews(
+            mapped,
+            ((col, ColumnView(mapped, col, converters.get(col)))
+             for col in cols)
+        )
+
+    def read_raw_table(self, table, typed=False):
         """
         Yield rows in the [incr tsdb()] `table`. A row is a dictionary
         mapping column names to values. Data from a profile is decoded
         by :py:func:`decode_row`. No filters or applicators are used.
-        """
+        If `typed` is True, values are converted according to the
+        column datatypes (see :py:func:`typed_value`).
 
+        If the table has a fresh columnar cache (see
+        :py:meth:`export_columnar`), rows are read from it instead of
+        the text table.
+        """
         field_names = [f.name for f in self.table_relations(table)]
-        field_len = len(field_names)
-        with self._open_table(table) as tbl:
-            for line in tbl:
-                fields = decode_row(line)
-                if len(fields) != field_len:
-                    # should this throw an exception instead?
-                    logging.error('Number of stored fields ({}) '
-                                  'differ from the expected number({}); '
-                                  'fields may be misaligned!'
-                                  .format(len(fields), field_len))
-                row = OrderedDict(zip(field_names, fields))
+        cache = self._columnar_cache(table) if self.use_cache else None
+        if cache is not None:
+            rows = (OrderedDict(zip(field_names, values))
+                    for values in self._read_columnar(table, cache, typed))
+            if typed:
+                rows = _typed_rows(self._table_converters(table), rows)
+            for row in rows:
+                yield row
+            return
+
+        if typed:
+            rows = self.read_raw_table(table)
+            for row in _typed_rows(self._table_converters(table), rows):
                 yield row
+            return
 
-    def read_table(self, table, key_filter=True):
+        rows = _decode_lines(self._open_table(table))
+        for row in self._field_rows(table, field_names, rows):
+            yield row
+
+    def _field_rows(self, table, field_names, rows):
+        # build row dictionaries from lists of decoded fields
+        field_len = len(field_names)
+        if self.interned_datatypes:
+            columns = [i for i, f in enumerate(self.table_relations(table))
+                       if f.datatype in self.interned_datatypes]
+            rows = self._intern_pool.intern_rows(table, columns, rows)
+        for fields in rows:
+            if len(fields) != field_len:
+                # should this throw an exception instead?
+                logging.error('Number of stored fields ({}) '
+                              'differ from the expected number({}); '
+                              'fields may be misaligned!'
+                              .format(len(fields), field_len))
+            row = OrderedDict(zip(field_names, fields))
+            yield row
+
+    def read_table(self, table, key_filter=True, typed=False, workers=0,
+                   limit=None, offset=0, sample=None, seed=None):
         """
         Yield rows in the [incr tsdb()] `table` that pass any defined
         filters, and with values changed by any applicators. If no
         filters or applicators are defined, the result is the same as
         from :py:meth:`ItsdbProfile.read_raw_table`.
+
+        If `typed` is True, string values of the rows that pass the
+        filters are converted according to the column datatypes (see
+        :py:func:`typed_value`). Filters and applicators still see the
+        decoded strings, so existing ones work unchanged.
+
+        If `workers` is greater than 0 and every filter that applies to
+        `table` is a compiled filter expression (see
+        :py:meth:`add_filter`) with no applicators on `table`, the
+        table is split at line boundaries into chunks that are
+        filtered by that many worker processes. The workers only send
+        back the offsets of the rows that pass, and only those rows are
+        decoded, so this pays off for selective filters on large
+        tables. Otherwise `workers` is ignored.
+
+        If `sample` is given, only a sample of the rows is yielded (see
+        :py:func:`sample_rows`), and `offset` and `limit` then skip and
+        cap the rows yielded (see :py:func:`limit_rows`). If no filters
+        apply to `table` and the rows are sampled, key-filtered, or the
+        `offset` is large, the rows are chosen from the key index
+        before anything is read, so only those rows are decoded;
+        otherwise rows are streamed and reading stops after the last
+        row needed.
         """
+        sliced = limit is not None or offset or sample is not None
+        by_offset = not (
+            self.use_cache and self._columnar_cache(table) is not None
+        )
+        allowed = None
+        if key_filter:
+            allowed = self._allowed_rows(table)
+            if allowed is None:
+                # every row passes, so no row needs to be checked
+                key_filter = False
+        # building the key index costs a full scan of the table, so
+        # plain limits and small offsets just stream the rows
+        indexed = (key_filter or sample is not None or
+                   offset >= _seek_offset)
+        if (sliced and by_offset and indexed and
+                not (self.filters[None] or self.filters[table])):
+            offsets = allowed if key_filter else self._row_offsets(table)
+            if offsets is not None:
+                if sample is not None:
+                    offsets = [offsets[i] for i in
+                               _sample_positions(len(offsets), sample, seed)]
+                offsets = list(limit_rows(offsets, limit, offset))
+                rows = self._read_rows_at(table, offsets)
+                return self._process_rows(table, rows, False, typed)
+        if workers > 0 and by_offset:
+            offsets = self._filtered_offsets(table, workers)
+            if offsets is not None:
+                if key_filter:
+                    offsets = _intersect_sorted(offsets, allowed)
+                rows = self._read_rows_at(table, offsets)
+                if typed:
+                    rows = _typed_rows(self._table_converters(table), rows)
+                return _slice_rows(rows, limit, offset, sample, seed)
+        if key_filter and by_offset:
+            rows = self._read_rows_at(table, allowed)
+            key_filter = False
+        else:
+            rows = self.read_raw_table(table)
+        rows = self._process_rows(table, rows, key_filter, typed)
+        return _slice_rows(rows, limit, offset, sample, seed)
+
+    def _filtered_offsets(self, table, workers):
+        # The offsets of the rows of `table` that pass its filters,
+        # computed by `workers` processes, or None if the filters
+        # cannot be run there (they are not all compiled expressions,
+        # or applicators must run first).
+        filters = self.filters[None] + self.filters[table]
+        if (not filters or self.applicators[table] or
+                not all(hasattr(f, 'expression') for _, f in filters)):
+            return None
+        fields = self.table_relations(table)
+        expressions = [(f.expression, None) for _, f in self.filters[None]]
+        expressions.extend((f.expression, fields)
+                           for _, f in self.filters[table])
+        return _scan_chunks_parallel(self._uncompressed_table(table),
+                                     fields, expressions, workers)
+
+    def _row_offsets(self, table):
+        # The sorted byte offsets of all rows, from the key index, or
+        # None if the table has no key column.
+        try:
+            key = self._default_key(table)
+        except ItsdbError:
+            return None
+        offsets = array('q')
+        for offs in self.key_offsets(table, key).values():
+            offsets.extend(offs)
+        return array('q', sorted(offsets))
+
+    def _read_rows_at(self, table, offsets):
+        # Only decode the rows starting at the byte `offsets`; when they
+        # are sorted, seeking forward within the read buffer does not
+        # touch the disk, so this is cheap for dense and sparse offsets
+        # alike. Rows are built by _field_rows() as for full reads.
+        field_names = [f.name for f in self.table_relations(table)]
+        path = self._uncompressed_table(table)
+
+        def lines():
+            with open(path, 'rb', buffering=_io_buffer_size) as f:
+                for offset in offsets:
+                    f.seek(offset)
+                    yield f.readline().decode('utf-8')
+
+        return self._field_rows(table, field_names, decode_rows(lines()))
+
+    def _process_rows(self, table, rows, key_filter, typed=False):
         filters = self.filters[None] + self.filters[table]
         if key_filter:
-            for f in self.relations[table]:
-                key = f.name
-                if f.key and (self._index.get(key) is not None):
-                    ids = self._index[key]
-                    # Can't keep local variables (like ids) in the scope of
-                    # the lambda expression, so make it a default argument.
-                    # Source: http://stackoverflow.com/a/938493/1441112
-                    function = lambda r, x, ids=ids: x in ids
-                    filters.append(([key], function))
+            index = self._key_sets()
+            checks = [(f.name, index[f.name]) for f in self.relations[table]
+                      if f.key and index.get(f.name) is not None]
+            if checks:
+                # one function tests all keys; default argument binding
+                # keeps `checks` in the lambda's scope
+                function = lambda r, x, checks=checks: all(
+                    r[k] in ids for k, ids in checks if k in r
+                )
+                filters.append(([None], function))
         applicators = self.applicators[table]
-        rows = self.read_raw_table(table)
-        return filter_rows(filters, apply_rows(applicators, rows))
+        rows = filter_rows(filters, apply_rows(applicators, rows))
+        if typed:
+            rows = _typed_rows(self._table_converters(table), rows)
+        return rows
+
+    def _default_key(self, table):
+        for keyname, tablename in _primary_keys:
+            if tablename == table:
+                return keyname
+        for f in self.table_relations(table):
+            if f.key:
+                return f.name
+        raise ItsdbError('Table "{}" has no key column.'.format(table))
+
+    def get(self, table, value, col=None, key_filter=False, typed=False):
+        """
+        Return the list of rows in `table` whose `col` column has
+        `value`. Rows are located through :py:meth:`key_offsets`, so
+        only the matching rows are read from disk. Filters and
+        applicators are used as in :py:meth:`read_table`.
 
-    def select(self, table, cols, mode='list', key_filter=True):
+        Args:
+            table: The name of the table to get rows from
+            value: The value of `col` to look up
+            col: The column to look up; if None, the table's primary
+                key (e.g. `parse-id` for `parse` or `result`)
+            key_filter: If True, filter the rows by keys in the index
+            typed: If True, convert values according to the column
+                datatypes (see :py:meth:`read_table`)
+        Returns:
+            A list of matching rows, in table order
+        """
+        return list(self.get_many(table, [value], col=col,
+                                  key_filter=key_filter, typed=typed))
+
+    def get_many(self, table, values, col=None, key_filter=False,
+                 typed=False):
+        """
+        Yield rows in `table` whose `col` column has one of `values`.
+        Rows are yielded in the order of `values`, and in table order
+        for each value. See :py:meth:`get`.
+        """
+        if col is None:
+            col = self._default_key(table)
+        index = self.key_offsets(table, col)
+        offsets = (offset for value in values
+                   for offset in index.get(str(value), ()))
+        rows = self._read_rows_at(table, offsets)
+        return self._process_rows(table, rows, key_filter, typed)
+
+    def select(self, table, cols, mode='list', key_filter=True,
+               columnar=False, typed=False, limit=None, offset=0,
+               sample=None, seed=None):
         """
         Yield selected rows from `table`. This method just calls
         :py:func:`select_rows` on the rows read from `table`.
+
+        If `columnar` is True, no applicators apply to `table`, and all
+        filters that apply are compiled expressions (see
+        :py:func:`compile_filter`), the table is read through the same
+        memory map as :py:meth:`read_columns` and row dictionaries are
+        never built; only the selected, key, and filter columns are
+        unescaped, and filters are only given the columns they use.
+
+        If `typed` is True, selected values are converted according to
+        the column datatypes (see :py:meth:`read_table`).
+
+        The `limit`, `offset`, `sample`, and `seed` arguments reduce the
+        selected rows as for :py:meth:`read_table`.
         """
         if cols is None:
             cols = [c.name for c in self.relations[table]]
-        rows = self.read_table(table, key_filter=key_filter)
-        for row in select_rows(cols, rows, mode=mode):
-            yield row
+        filters = self.filters[None] + self.filters[table]
+        if (columnar and not self.applicators[table] and
+                all(hasattr(f, 'columns') for _, f in filters)):
+            rows = self._select_columns(table, cols, key_filter, filters,
+                                        typed)
+            rows = _slice_rows(rows, limit, offset, sample, seed)
+            cast = _select_cast(mode)
+            for data in rows:
+                yield cast(cols, data)
+        else:
+            rows = self.read_table(table, key_filter=key_filter, typed=typed,
+                                   limit=limit, offset=offset,
+                                   sample=sample, seed=seed)
+            for row in select_rows(cols, rows, mode=mode):
+                yield row
+
+    def _select_columns(self, table, cols, key_filter, filters, typed):
+        names = [f.name for f in self.relations[table]]
+        keys, index = [], {}
+        if key_filter and self._allowed_rows(table) is not None:
+            index = self._key_sets()
+            keys = [f.name for f in self.relations[table]
+                    if f.key and index.get(f.name) is not None]
+        conditions = [f for fcols, f in filters
+                      if any(c is None or c in names for c in fcols)]
+        filter_cols = list(OrderedDict.fromkeys(
+            c for f in conditions for c in f.columns if c in names
+        ))
+        # only the selected, key, and filter fields are unescaped
+        positions = list(OrderedDict.fromkeys(
+            names.index(c) for c in chain(cols, keys, filter_cols)
+        ))
+        picked = dict((names[k], j) for j, k in enumerate(positions))
+        select = [picked[c] for c in cols]
+        if select == list(range(len(positions))):
+            select = None  # the picked fields are already the selection
+        converters = dict(self._table_converters(table)) if typed else {}
+        converters = [(j, converters[c]) for j, c in enumerate(cols)
+                      if c in converters]
+        key_checks = [(picked[k], index[k]) for k in keys]
+        filter_positions = [(c, picked[c]) for c in filter_cols]
+        with self._mapped_table(table) as mapped:
+            for fields in mapped.rows(cols=positions):
+                if key_checks and not all(fields[j] in ids
+                                          for j, ids in key_checks):
+                    continue
+                if conditions:
+                    row = dict((c, fields[j]) for c, j in filter_positions)
+                    if not all(f(row, None) for f in conditions):
+                        continue
+                if select is not None:
+                    fields = [fields[j] for j in select]
+                for j, convert in converters:
+                    fields[j] = convert(fields[j])
+                yield fields
 
     def join(self, table1, table2, key_filter=True):
         """
@@ -606,32 +2669,196 @@ class ItsdbProfile:
         prepended and separated by a colon. For example, joining tables
         'item' and 'parse' will result in column names like
         'item:i-input' and 'parse:parse-id'.
+
+        See :py:meth:`join_tables` for joins over more than two tables
+        and for lighter-weight tuple rows.
         """
-        get_keys = lambda t: (f.name for f in self.relations[t] if f.key)
-        keys = set(get_keys(table1)).intersection(get_keys(table2))
-        key = keys.pop()
-        if key is None:
-            raise StopIteration
-        # this join method stores the whole of table2 in memory, but it is
-        # MUCH faster than a nested loop method. Most profiles will fit in
-        # memory anyway, so it's a decent tradeoff
-        table2_data = defaultdict(list)
-        for row in self.read_table(table2, key_filter=key_filter):
-            table2_data[row[key]].append(row)
-        for row1 in self.read_table(table1, key_filter=key_filter):
-            for row2 in table2_data.get(row1[key], []):
-                joinedrow = OrderedDict(
-                    [('{}:{}'.format(table1, k), v)
-                     for k, v in row1.items()] +
-                    [('{}:{}'.format(table2, k), v)
-                     for k, v in row2.items()]
-                )
-                yield joinedrow
+        names = ['{}:{}'.format(table, f.name)
+                 for table in (table1, table2)
+                 for f in self.table_relations(table)]
+        rows = self.join_tables([table1, table2], cols=names,
+                                key_filter=key_filter)
+        for data in rows:
+            yield OrderedDict(zip(names, data))
+
+    def join_tables(self, tables, cols=None, key_filter=True):
+        """
+        Yield tuples of column values from joining all `tables`.
+
+        Each table is joined to the ones before it on its first key
+        column (in relations order) that is also a key of a previous
+        table, so `['item', 'parse', 'result']` joins `parse` on `i-id`
+        and `result` on `parse-id`. When a table is sorted by its join
+        key (as [incr tsdb()] tables usually are; this is checked with
+        :py:meth:`key_offsets`), it is streamed alongside the rows
+        before it as a merge join, buffering only the rows of the
+        current key; keys that arrive out of order are looked up by
+        offset instead. Otherwise the smaller side is held in memory
+        as a hash join. Either way, rows are yielded in the order of
+        the first table.
+
+        Args:
+            tables: The names of the tables to join, in order
+            cols: The columns to yield, given as `table:col` strings;
+                if None, all columns of all tables are yielded
+            key_filter: If True, filter the rows by keys in the index
+        Yields:
+            Tuples of the values of `cols` for each joined row
+        """
+        tables = list(tables)
+        if len(tables) < 2:
+            raise ItsdbError('At least two tables are needed for a join.')
+        if cols is None:
+            cols = ['{}:{}'.format(table, f.name)
+                    for table in tables for f in self.table_relations(table)]
+        projection = []
+        for col in cols:
+            table, _, name = col.rpartition(':')
+            if table not in tables:
+                raise ItsdbError('Cannot select "{}"; table "{}" is not '
+                                 'joined.'.format(col, table))
+            if name not in [f.name for f in self.table_relations(table)]:
+                raise ItsdbError('Column "{}" not defined for table "{}".'
+                                 .format(name, table))
+            projection.append((tables.index(table), name))
+
+        rows = ((row,) for row in self.read_table(tables[0], key_filter))
+        for i in range(1, len(tables)):
+            key, left = self._join_key(tables[:i], tables[i])
+            rows = self._join_step(rows, tables[:i], left, tables[i], key,
+                                   key_filter)
+        for joined in rows:
+            yield tuple(joined[i].get(name) for i, name in projection)
+
+    def _join_key(self, left_tables, table):
+        keys = lambda t: [f.name for f in self.table_relations(t) if f.key]
+        for key in keys(table):
+            for i in range(len(left_tables) - 1, -1, -1):
+                if key in keys(left_tables[i]):
+                    return key, i
+        raise ItsdbError('Cannot join table "{}"; it shares no key with {}.'
+                         .format(table, ', '.join(left_tables)))
+
+    def is_sorted_by(self, table, col):
+        """
+        Return True if the rows of `table` are in order of their `col`
+        values (integer values numerically), as determined from the
+        key offset index (see :py:meth:`key_offsets`).
+        """
+        prev = -1
+        offsets = self.key_offsets(table, col)
+        for value in sorted(offsets, key=_key_order):
+            if offsets[value][0] < prev:
+                return False
+            prev = offsets[value][-1]
+        return True
+
+    def _join_step(self, rows, left_tables, left, table, key, key_filter):
+        if self.is_sorted_by(table, key):
+            cursor = _MergeCursor(
+                self.read_table(table, key_filter=key_filter),
+                key,
+                lambda value: list(self.get_many(table, [value], col=key,
+                                                 key_filter=key_filter))
+            )
+            for joined in rows:
+                for row in cursor.lookup(joined[left][key]):
+                    yield joined + (row,)
+        elif (len(left_tables) == 1 and
+              self._row_count(left_tables[0], key) <
+              self._row_count(table, key)):
+            # hold the (smaller) first table and only the rows of the
+            # other one that match it, then join in first-table order
+            lefts = list(rows)
+            values = set(joined[left][key] for joined in lefts)
+            data = defaultdict(list)
+            for row in self.read_table(table, key_filter=key_filter):
+                if row[key] in values:
+                    data[row[key]].append(row)
+            for joined in lefts:
+                for row in data.get(joined[left][key], []):
+                    yield joined + (row,)
+        else:
+            data = defaultdict(list)
+            for row in self.read_table(table, key_filter=key_filter):
+                data[row[key]].append(row)
+            for joined in rows:
+                for row in data.get(joined[left][key], []):
+                    yield joined + (row,)
+
+    def _row_count(self, table, col):
+        return sum(map(len, self.key_offsets(table, col).values()))
+
+    def append_session(self, buffer_size=None, gzip=False,
+                       compresslevel=None):
+        """
+        Return an :py:class:`AppendSession` for appending rows to this
+        profile in batches with crash-safe checkpoints. If a previous
+        session on this profile did not finish, its uncommitted data is
+        removed and its last checkpoint marker is available as
+        :py:attr:`AppendSession.last_committed`.
+        """
+        return AppendSession(self, buffer_size=buffer_size, gzip=gzip,
+                             compresslevel=compresslevel)
 
-    def write_table(self, table, rows, append=False, gzip=False):
+    def aggregate(self, tables, aggregates, group_by=None, key_filter=True):
+        """
+        Compute aggregate statistics over one table or a join of tables
+        in a single streaming pass. See :py:func:`aggregate_rows` for
+        the available aggregates. Values are typed according to the
+        relations (see :py:meth:`read_table`).
+
+        For example, to get the coverage and mean number of readings
+        per item well-formedness value::
+
+            prof.aggregate(['item', 'parse'],
+                           ['count', 'mean(parse:readings)'],
+                           group_by=['item:i-wf'])
+
+        Args:
+            tables: The name of a table, or a list of tables to join
+                (see :py:meth:`join_tables`); for joins, columns are
+                given as `table:col` strings
+            aggregates: The aggregate strings
+            group_by: The columns whose values define the groups
+            key_filter: If True, filter the rows by keys in the index
+        Returns:
+            A list of OrderedDicts (see :py:func:`aggregate_rows`)
+        """
+        if isinstance(tables, str):
+            tables = [tables]
+        if len(tables) == 1:
+            rows = self.read_table(tables[0], key_filter=key_filter,
+                                   typed=True)
+        else:
+            cols = list(group_by or [])
+            cols.extend(col for col, _, _ in map(_parse_aggregate, aggregates)
+                        if col is not None)
+            cols = list(OrderedDict.fromkeys(cols))
+            converters = []
+            for col in cols:
+                table, _, name = col.rpartition(':')
+                if table in tables:
+                    converters.extend(
+                        (col, conv) for n, conv
+                        in self._table_converters(table) if n == name
+                    )
+            rows = _typed_rows(
+                converters,
+                (dict(zip(cols, data)) for data in
+                 self.join_tables(tables, cols=cols, key_filter=key_filter))
+            )
+        return aggregate_rows(rows, aggregates, group_by=group_by)
+
+    def write_table(self, table, rows, append=False, gzip=False,
+                    compresslevel=None, parallel_gzip=False):
         """
         Encode and write out `table` to the profile directory.
 
+        Rows are encoded and written in large batches. Appending to a
+        gzipped table adds a new gzip member (readers decompress all
+        members as a single stream).
+
         Args:
             table: The name of the table to write
             rows: The rows to write to the table
@@ -639,17 +2866,24 @@ class ItsdbProfile:
                 data.
             gzip: If True, compress the resulting table with `gzip`.
                 The table's filename will have `.gz` appended.
+            compresslevel: The gzip compression level (1-9); if None,
+                a moderate default (6) is used.
+            parallel_gzip: If True and the `pigz` command is available,
+                compress with it to use multiple cores.
         """
         _write_table(self.root,
                      table,
                      rows,
                      self.table_relations(table),
                      append=append,
-                     gzip=gzip)
+                     gzip=gzip,
+                     compresslevel=compresslevel,
+                     parallel_gzip=parallel_gzip)
 
     def write_profile(self, profile_directory, relations_filename=None,
                       key_filter=True,
-                      append=False, gzip=None):
+                      append=False, gzip=None, compresslevel=None,
+                      parallel_gzip=False):
         """
         Write all tables (as specified by the relations) to a profile.
 
@@ -663,6 +2897,10 @@ class ItsdbProfile:
             gzip: If True, compress tables using `gzip`. Table filenames
                 will have `.gz` appended. If False, only write out text
                 files. If None, use whatever the original file was.
+            compresslevel: The gzip compression level (see
+                :py:meth:`write_table`)
+            parallel_gzip: If True, compress with `pigz` if available
+                (see :py:meth:`write_table`)
         """
         import shutil
         if relations_filename:
@@ -686,4 +2924,557 @@ class ItsdbProfile:
             _gzip = gzip if gzip is not None else fn.endswith('.gz')
             rows = self.read_table(table, key_filter=key_filter)
             _write_table(profile_directory, table, rows, fields,
-                         append=append, gzip=_gzip)
+                         append=append, gzip=_gzip,
+                         compresslevel=compresslevel,
+                         parallel_gzip=parallel_gzip)
+
+
+class AppendSession(object):
+    """
+    A session for incrementally appending rows to a profile's tables.
+
+    Rows are encoded when appended and buffered in memory; buffers are
+    written to the table files with one large write per table when
+    they grow past `buffer_size` bytes or when :py:meth:`flush` or
+    :py:meth:`commit` is called. Gzipped tables get a complete gzip
+    member for each write.
+
+    :py:meth:`commit` writes any buffered rows, syncs the table files
+    to disk, and records a checkpoint with the size of each table and
+    a caller-supplied marker (e.g. the last `i-id` that was fully
+    processed). If the process dies, the next session on the profile
+    finds the checkpoint, truncates each table to its committed size
+    (removing any torn or uncommitted rows), and makes the marker
+    available as :py:attr:`last_committed` so the job can resume from
+    there. Closing a session normally commits it and removes the
+    checkpoint.
+
+    Persisted key offset indices (see :py:meth:`ItsdbProfile.key_offsets`)
+    of plain-text tables are updated with the offsets of appended rows
+    rather than rebuilt.
+
+    Sessions are usually created with
+    :py:meth:`ItsdbProfile.append_session` and used as a context
+    manager::
+
+        with prof.append_session() as session:
+            for item in items_after(session.last_committed):
+                session.append('parse', make_parse_row(item))
+                session.commit(item['i-id'])
+    """
+
+    _checkpoint_filename = 'append-checkpoint'
+
+    def __init__(self, profile, buffer_size=None, gzip=False,
+                 compresslevel=None):
+        """
+        Args:
+            profile: The :py:class:`ItsdbProfile` to append to
+            buffer_size: The number of bytes of encoded rows to buffer
+                before writing; if None, a 1MB default is used
+            gzip: If True, tables that do not yet exist are created
+                gzipped; existing tables keep their format
+            compresslevel: The gzip compression level (see
+                :py:meth:`ItsdbProfile.write_table`)
+        """
+        self.profile = profile
+        self.buffer_size = buffer_size or _io_buffer_size
+        self.gzip = gzip
+        self.compresslevel = compresslevel
+        self.last_committed = None
+        self._buffers = defaultdict(list)
+        self._buffered = 0
+        self._indexed = dict()  # table -> list of (col position, offsets)
+        self._checkpoint = os.path.join(_profile_cache_dir(profile.root),
+                                        self._checkpoint_filename)
+        if os.path.exists(self._checkpoint):
+            self._recover()
+        else:
+            self._write_checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        return False  # don't try to handle any exceptions
+
+    def _table_filename(self, table):
+        filename = os.path.join(self.profile.root, table)
+        if os.path.exists(filename):
+            return filename
+        elif os.path.exists(filename + '.gz') or self.gzip:
+            return filename + '.gz'
+        return filename
+
+    def _recover(self):
+        with open(self._checkpoint) as f:
+            checkpoint = json.load(f)
+        for filename, size in checkpoint['sizes'].items():
+            path = os.path.join(self.profile.root, filename)
+            if not os.path.exists(path):
+                continue
+            if os.path.getsize(path) > size:
+                logging.warning('Removing uncommitted data from {}.'
+                                .format(path))
+                with open(path, 'r+b') as f:
+                    f.truncate(size)
+            elif os.path.getsize(path) < size:
+                logging.error('{} is smaller than when it was committed.'
+                              .format(path))
+        for table in self.profile.relations:
+            for filename in (table, table + '.gz'):
+                path = os.path.join(self.profile.root, filename)
+                # tables created after the last commit
+                if (filename not in checkpoint['sizes'] and
+                        os.path.exists(path)):
+                    logging.warning('Removing uncommitted table {}.'
+                                    .format(path))
+                    os.remove(path)
+        self.last_committed = checkpoint['committed']
+        self.profile._key_offsets.clear()
+        self._reset_index()
+
+    def _write_checkpoint(self):
+        sizes = {}
+        for table in self.profile.relations:
+            for filename in (table, table + '.gz'):
+                path = os.path.join(self.profile.root, filename)
+                if os.path.exists(path):
+                    sizes[filename] = os.path.getsize(path)
+        checkpoint = {'committed': self.last_committed, 'sizes': sizes}
+        tmp_filename = '{}.{}.tmp'.format(self._checkpoint, os.getpid())
+        with open(tmp_filename, 'w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self._checkpoint)
+
+    def _reset_index(self):
+        # the cascading key sets are rebuilt (from the key offsets) when
+        # next needed; an empty dict means indexing is disabled
+        if self.profile._index:
+            self.profile._index = None
+
+    def _track_offsets(self, table):
+        # load the persisted key offsets of a plain table before it
+        # changes so they can be extended instead of rebuilt
+        filename = self._table_filename(table)
+        tracked = []
+        if not filename.endswith('.gz') and os.path.exists(filename):
+            cache_dir = _profile_cache_dir(self.profile.root)
+            fields = [f.name for f in self.profile.table_relations(table)]
+            prefix = table + '.'
+            for fn in os.listdir(cache_dir):
+                col = fn[len(prefix):-len('.idx')]
+                if (fn.startswith(prefix) and fn.endswith('.idx') and
+                        col in fields):
+                    offsets = self.profile.key_offsets(table, col)
+                    tracked.append((col, fields.index(col), offsets))
+        else:
+            for key in list(self.profile._key_offsets):
+                if key[0] == table:
+                    del self.profile._key_offsets[key]
+        self._indexed[table] = tracked
+
+    def append(self, table, row):
+        """
+        Encode `row` (a mapping of column names to values; see
+        :py:func:`make_row`) and buffer it for appending to `table`.
+        """
+        if table not in self._indexed:
+            self._track_offsets(table)
+        line = make_row(row, self.profile.table_relations(table))
+        self._buffers[table].append(line)
+        self._buffered += len(line) + 1
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def extend(self, table, rows):
+        """
+        Encode and buffer each row in `rows` for appending to `table`.
+        """
+        for row in rows:
+            self.append(table, row)
+
+    def flush(self, sync=False):
+        """
+        Write all buffered rows to their tables with one write per
+        table. If `sync` is True, the files are synced to disk.
+        """
+        for table, lines in self._buffers.items():
+            if lines:
+                self._write(table, lines, sync)
+        self._buffers.clear()
+        self._buffered = 0
+
+    def _write(self, table, lines, sync):
+        filename = self._table_filename(table)
+        data = [(line + '\n').encode('utf-8') for line in lines]
+        with open(filename, 'ab') as raw:
+            pos = raw.tell()
+            if filename.endswith('.gz'):
+                compresslevel = self.compresslevel
+                if compresslevel is None:
+                    compresslevel = _gzip_compresslevel
+                with GzipFile(fileobj=raw, mode='ab',
+                              compresslevel=compresslevel) as f:
+                    f.write(b''.join(data))
+            else:
+                raw.write(b''.join(data))
+            raw.flush()
+            if sync:
+                os.fsync(raw.fileno())
+        tracked = self._indexed.get(table, [])
+        for key in list(self.profile._key_offsets):
+            if key[0] == table and key[1] not in [t[0] for t in tracked]:
+                del self.profile._key_offsets[key]
+        delim = _field_delimiter.encode('utf-8')
+        for col, i, offsets in tracked:
+            offset = pos
+            for line in data:
+                value = line.strip().split(delim)
+                if i < len(value):
+                    value = unescape(value[i].decode('utf-8'))
+                    if value not in offsets:
+                        offsets[value] = array('q')
+                    offsets[value].append(offset)
+                offset += len(line)
+
+    def commit(self, marker=None):
+        """
+        Write and sync all buffered rows and record a checkpoint. If
+        `marker` is not None, it becomes :py:attr:`last_committed`; it
+        must be JSON-serializable.
+        """
+        self.flush(sync=True)
+        if marker is not None:
+            self.last_committed = marker
+        for table, tracked in self._indexed.items():
+            for col, _, offsets in tracked:
+                self.profile._save_key_offsets(table, col, offsets)
+        self._reset_index()
+        self._write_checkpoint()
+
+    def close(self):
+        """
+        Commit the session and remove its checkpoint.
+        """
+        self.commit()
+        os.remove(self._checkpoint)
+
+
+##############################################################################
+# Profile diffs
+
+# keys for matching rows across profiles, where the primary key is not
+# stable (parse-ids are assigned per run, but items are parsed once)
+_diff_keys = {'parse': 'i-id', 'result': ('i-id', 'result-id')}
+# key columns that a table does not store are looked up through another
+# table: table -> (other table, shared column)
+_diff_lookups = {'result': ('parse', 'parse-id')}
+# identifiers that differ between runs of the same items
+_diff_ignored = frozenset(['run-id', 'parse-id', 'date', 'i-date'])
+# measurements that are expected to vary; they are summed as deltas
+# but do not make rows count as changed
+_diff_measures = frozenset([
+    'first', 'total', 'tcpu', 'tgc', 'treal', 'words', 'l-stasks',
+    'p-ctasks', 'p-ftasks', 'p-etasks', 'p-stasks', 'aedges', 'pedges',
+    'raedges', 'rpedges', 'tedges', 'eedges', 'ledges', 'sedges',
+    'redges', 'unifications', 'copies', 'conses', 'symbols', 'others',
+    'gcs', 'i-load', 'a-load', 'time', 'r-ctasks', 'r-ftasks',
+    'r-etasks', 'r-stasks', 'size', 'r-aedges', 'r-pedges'
+])
+
+TableDiff = namedtuple(
+    'TableDiff',
+    ['table', 'key', 'added', 'removed', 'changed', 'same', 'deltas']
+)
+TableDiff.__doc__ = """
+The differences between a table in two profiles.
+
+Attributes:
+    table: the table name
+    key: the column rows were matched on, or a tuple of columns for
+        composite keys (whose values are then tuples as well)
+    added: the list of key values only in the second profile
+    removed: the list of key values only in the first profile
+    changed: an OrderedDict mapping key values of changed rows to the
+        changes (see :py:func:`diff_rows`)
+    same: the number of key values with unchanged rows
+    deltas: an OrderedDict mapping measured columns to the sum of
+        their differences over the matched rows
+"""
+
+
+def diff_rows(rows1, rows2, key, compare=None, measures=(),
+              presorted=False, buffer_size=None):
+    """
+    Yield `(value, status, changes, deltas)` for each value of `key` in
+    `rows1` or `rows2`, in key order.
+
+    The status is `"removed"` if the value only occurs in `rows1`,
+    `"added"` if it only occurs in `rows2`, `"changed"` if any of the
+    `compare` columns differ between the rows with the value, and
+    `"same"` otherwise. `changes` maps the differing columns to
+    `(old, new)` pairs of values, or of tuples of values if either
+    side has several rows with the value. `deltas` maps each of the
+    `measures` columns to the sum of its values in `rows2` minus that
+    in `rows1`, for matched values only. Rows are matched as streams
+    by :py:func:`match_rows`, with `presorted` and `buffer_size`.
+
+    Args:
+        rows1: the old rows
+        rows2: the new rows
+        key: the column to match rows on
+        compare: the columns to compare; if None, all columns of the
+            first row on each side except `key` and `measures`
+        measures: numeric columns to compute deltas for
+        presorted: if True, the rows are already in key order
+        buffer_size: the number of rows held in memory when sorting
+    """
+    matched = match_rows(rows1, rows2, key, presorted=presorted,
+                         buffer_size=buffer_size)
+    for value, left, right in matched:
+        if not left:
+            yield (value, 'added', OrderedDict(), OrderedDict())
+            continue
+        if not right:
+            yield (value, 'removed', OrderedDict(), OrderedDict())
+            continue
+        cols = compare
+        if cols is None:
+            cols = [c for c in left[0]
+                    if c != key and c not in measures and c in right[0]]
+        changes = OrderedDict()
+        for col in cols:
+            old = tuple(row.get(col) for row in left)
+            new = tuple(row.get(col) for row in right)
+            if old != new:
+                if len(old) == len(new) == 1:
+                    old, new = old[0], new[0]
+                changes[col] = (old, new)
+        deltas = OrderedDict()
+        for col in measures:
+            old = [_to_number(row.get(col)) for row in left]
+            new = [_to_number(row.get(col)) for row in right]
+            if None not in old and None not in new:
+                deltas[col] = sum(new) - sum(old)
+        status = 'changed' if changes else 'same'
+        yield (value, status, changes, deltas)
+
+
+def _diff_table_rows(profile, table, key, key_filter):
+    # the rows of `table`; for composite keys, each row also maps the
+    # tuple of key columns to the tuple of its values, with columns the
+    # table does not store looked up (see _diff_lookups)
+    rows = profile.read_table(table, key_filter=key_filter)
+    if not isinstance(key, tuple):
+        return rows
+    names = [f.name for f in profile.table_relations(table)]
+    missing = [col for col in key if col not in names]
+    lookup = None
+    if missing:
+        if table not in _diff_lookups:
+            raise ItsdbError('Columns {} are not defined for table "{}".'
+                             .format(', '.join(missing), table))
+        other, shared = _diff_lookups[table]
+        lookup = dict(
+            (data[0], data[1:]) for data in
+            profile.select(other, [shared] + missing, key_filter=key_filter)
+        )
+        unknown = ('',) * len(missing)
+
+    def keyed_rows():
+        for row in rows:
+            if lookup is not None:
+                row.update(zip(missing, lookup.get(row[shared], unknown)))
+            row[key] = tuple(row[col] for col in key)
+            yield row
+
+    return keyed_rows()
+
+
+def diff_profiles(profile1, profile2, tables=None, keys=None,
+                  key_filter=True, buffer_size=None, measures=None):
+    """
+    Compare the tables of two profiles, reading each table once.
+
+    Rows are matched on the table's primary key, except for `parse`
+    rows, which are matched on `i-id` because parse-ids are assigned
+    anew by each run, and `result` rows, which are matched on
+    `(i-id, result-id)` with the `i-id` of each result's parse looked
+    up in the same profile's `parse` table. Run identifiers and dates
+    are not compared, and
+    timing, memory, and chart statistics are summed as deltas instead
+    of being compared. Tables stored in key order, as determined from
+    their key offset indexes, are merged as streams, so the comparison
+    scales linearly with the size of the profiles.
+
+    Args:
+        profile1: the old (e.g., gold) :py:class:`ItsdbProfile`
+        profile2: the new (e.g., test) :py:class:`ItsdbProfile`
+        tables: the tables to compare; if None, the `item`, `parse`,
+            and `result` tables
+        keys: a mapping of table names to the column (or tuple of
+            columns) to match rows on
+        key_filter: if True, filter rows by the cascading key index
+        buffer_size: the number of rows held in memory when a table
+            is not stored in key order
+        measures: the columns that are summed as deltas instead of
+            compared; if None, the timing, memory, and chart statistics
+            of [incr tsdb()]
+    Returns:
+        An OrderedDict mapping table names to :py:class:`TableDiff`
+        objects
+    """
+    if tables is None:
+        tables = ('item', 'parse', 'result')
+    measured = _diff_measures if measures is None else frozenset(measures)
+    results = OrderedDict()
+    for table in tables:
+        key = (keys or {}).get(table) or _diff_keys.get(table)
+        if key is None:
+            key = profile1._default_key(table)
+        key_cols = key if isinstance(key, tuple) else (key,)
+        fields1 = profile1.table_relations(table)
+        names2 = set(f.name for f in profile2.table_relations(table))
+        compare = [f.name for f in fields1
+                   if f.name in names2 and f.name not in key_cols and
+                   f.name not in _diff_ignored and
+                   f.name not in measured]
+        table_measures = [f.name for f in fields1
+                          if f.name in names2 and f.name in measured and
+                          f.name not in key_cols]
+        presorted = (not isinstance(key, tuple) and
+                     profile1.is_sorted_by(table, key) and
+                     profile2.is_sorted_by(table, key))
+        diff = TableDiff(table, key, [], [], OrderedDict(), 0,
+                         OrderedDict((col, 0) for col in table_measures))
+        same = 0
+        rows = diff_rows(_diff_table_rows(profile1, table, key, key_filter),
+                         _diff_table_rows(profile2, table, key, key_filter),
+                         key, compare=compare, measures=table_measures,
+                         presorted=presorted, buffer_size=buffer_size)
+        for value, status, changes, deltas in rows:
+            if status == 'added':
+                diff.added.append(value)
+            elif status == 'removed':
+                diff.removed.append(value)
+            elif status == 'changed':
+                diff.changed[value] = changes
+            else:
+                same += 1
+            for col, delta in deltas.items():
+                diff.deltas[col] += delta
+        results[table] = diff._replace(same=same)
+    return results
+
+
+##############################################################################
+# Profile sets
+
+def _profile_task(task):
+    path, options, method, args, kwargs = task
+    start = time.time()
+    prof = ItsdbProfile(path, **options)
+    if isinstance(method, str):
+        result = getattr(prof, method)(*args, **kwargs)
+    else:
+        result = method(prof, *args, **kwargs)
+    if not isinstance(result, (list, tuple, dict, str, int, float,
+                               type(None))):
+        result = list(result)
+    return result, time.time() - start
+
+
+class ProfileSet(object):
+    """
+    A collection of [incr tsdb()] profiles that are queried together.
+
+    Queries are run on each profile in a pool of worker processes (see
+    :py:class:`concurrent.futures.ProcessPoolExecutor`), and results are
+    yielded as `(path, result)` pairs in the order of the profile paths
+    as soon as each is available. The time (in seconds) each profile
+    took, including opening it, is recorded in :py:attr:`timings`.
+
+    Filters and applicators are given as for :py:class:`ItsdbProfile`,
+    but since profiles are opened in the worker processes the
+    functions must be picklable (e.g. module-level functions, not
+    lambdas). Filter expressions (see :py:func:`compile_filter`) are
+    strings and can always be used.
+    """
+
+    def __init__(self, paths, filters=None, applicators=None, index=True,
+                 workers=None):
+        """
+        Args:
+            paths: The paths of the profile directories
+            filters: Filters for each profile (see :py:class:`ItsdbProfile`)
+            applicators: Applicators for each profile (see
+                :py:class:`ItsdbProfile`)
+            index: If True, use key indices (see :py:class:`ItsdbProfile`)
+            workers: The number of worker processes; if None, the
+                number of CPUs is used; if 0, profiles are queried in
+                the current process
+        """
+        self.paths = list(paths)
+        self.options = {
+            'filters': filters,
+            'applicators': applicators,
+            'index': index
+        }
+        self.workers = workers
+        self.timings = OrderedDict()
+
+    def map(self, function, *args, **kwargs):
+        """
+        Yield `(path, result)` pairs where `result` is the return value
+        of `function(profile, *args, **kwargs)` for each profile.
+        Iterator results are collected into lists. `function` may also
+        be the name of an :py:class:`ItsdbProfile` method.
+        """
+        tasks = [(path, self.options, function, args, kwargs)
+                 for path in self.paths]
+        if self.workers == 0:
+            results = map(_profile_task, tasks)
+            for path, (result, elapsed) in zip(self.paths, results):
+                self.timings[path] = elapsed
+                yield path, result
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                results = executor.map(_profile_task, tasks)
+                for path, (result, elapsed) in zip(self.paths, results):
+                    self.timings[path] = elapsed
+                    yield path, result
+
+    def read_table(self, table, key_filter=True, typed=False, limit=None,
+                   offset=0, sample=None, seed=None):
+        """
+        Yield `(path, rows)` pairs of the rows from
+        :py:meth:`ItsdbProfile.read_table` for each profile.
+        """
+        return self.map('read_table', table, key_filter=key_filter,
+                        typed=typed, limit=limit, offset=offset,
+                        sample=sample, seed=seed)
+
+    def aggregate(self, tables, aggregates, group_by=None, key_filter=True):
+        """
+        Yield `(path, results)` pairs of the results from
+        :py:meth:`ItsdbProfile.aggregate` for each profile.
+        """
+        return self.map('aggregate', tables, aggregates, group_by=group_by,
+                        key_filter=key_filter)
+
+    def select(self, table, cols, mode='list', key_filter=True,
+               columnar=False, typed=False, limit=None, offset=0,
+               sample=None, seed=None):
+        """
+        Yield `(path, rows)` pairs of the rows from
+        :py:meth:`ItsdbProfile.select` for each profile.
+        """
+        return self.map('select', table, cols, mode=mode,
+                        key_filter=key_filter, columnar=columnar,
+                        typed=typed, limit=limit, offset=offset,
+                        sample=sample, seed=seed)
@@ -0,0 +1,380 @@
+# -*- coding: UTF-8 -*-
+import os
+import sys
+import stat
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from delphin import itsdb
+from delphin.interfaces import ace
+from tests.helpers import make_profile, use_temporary_cache, restore_cache
+
+# A stand-in for the ACE binary that answers each input line in the
+# format ACE uses, so the interface can be tested without a grammar.
+_fake_ace = '''#!{python}
+import sys
+import time
+generate = '-e' in sys.argv
+for line in sys.stdin:
+    line = line.strip()
+    if line == 'crash':
+        sys.exit(1)
+    elif line.startswith('sleep'):
+        time.sleep(float(line.split()[1]))
+    if generate:
+        sys.stdout.write('Generated {{}}.\\n'.format(line))
+        sys.stdout.write('NOTE: 1 passive, 1 active edges in final '
+                         'generation chart; built 1 passives total. '
+                         '[1 results]\\n')
+    else:
+        sys.stdout.write('SENT: {{}}\\n'.format(line))
+        for i in range(len(line.split())):
+            sys.stdout.write('[ LTOP: h{{0}} ] ; (derivation {{0}})\\n'
+                             .format(i))
+        sys.stdout.write('\\n')
+        sys.stdout.write('NOTE: {{}} readings, added 10 / 5 edges to chart '
+                         '(4 fully instantiated, 3 actives used, '
+                         '2 passives used)\\tRAM: 1024k\\n'
+                         .format(len(line.split())))
+        sys.stdout.write('\\n')
+    sys.stdout.flush()
+sys.stdout.write('NOTE: {{}} 3 / 3 sentences, avg 1024k, time 0.01234s\\n'
+                 .format('generated' if generate else 'parsed'))
+'''
+
+
+def make_fake_ace(root):
+    """Write the fake ACE executable and a grammar file to `root`."""
+    path = os.path.join(root, 'ace')
+    with open(path, 'w') as f:
+        f.write(_fake_ace.format(python=sys.executable))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IEXEC)
+    grm = os.path.join(root, 'grammar.dat')
+    with open(grm, 'w') as f:
+        f.write('')
+    return path, grm
+
+
+def setUpModule():
+    use_temporary_cache()
+
+
+def tearDownModule():
+    restore_cache()
+
+
+class TestAceParser(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_interact(self):
+        with ace.AceParser(self.grm, executable=self.ace) as parser:
+            response = parser.interact('the dog barks')
+        self.assertEqual(response['SENT'], 'the dog barks')
+        self.assertEqual(len(response['RESULTS']), 3)
+        self.assertEqual(response['RESULTS'][0]['DERIV'], '(derivation 0)')
+
+    def test_interact_many(self):
+        data = ['w' * (i % 5 + 1) + ' x' * (i % 3) for i in range(200)]
+        responses = list(ace.parse_from_iterable(
+            self.grm, data, in_flight=8, executable=self.ace
+        ))
+        self.assertEqual([r['SENT'] for r in responses], data)
+        self.assertEqual([len(r['RESULTS']) for r in responses],
+                         [len(d.split()) for d in data])
+        # stopping early does not hang
+        responses = ace.parse_from_iterable(self.grm, iter(data),
+                                            executable=self.ace)
+        self.assertEqual(next(responses)['SENT'], data[0])
+        responses.close()
+
+
+class TestAceResult(unittest.TestCase):
+    def test_lazy(self):
+        result = ace.AceResult('[ LTOP: h0 ] ; (derivation 0)\n')
+        self.assertIsNone(result._fields)
+        self.assertEqual(dict(result),
+                         {'MRS': '[ LTOP: h0 ]', 'DERIV': '(derivation 0)'})
+        simplemrs = mock.Mock()
+        simplemrs.loads_one.return_value = object()
+        module = mock.Mock(simplemrs=simplemrs)
+        with mock.patch.dict('sys.modules', {'delphin.mrs': module}):
+            xmrs = result.xmrs
+            self.assertIs(result.xmrs, xmrs)
+        simplemrs.loads_one.assert_called_once_with('[ LTOP: h0 ]')
+
+    def test_parser_results(self):
+        import json
+        tmp = tempfile.mkdtemp()
+        try:
+            executable, grm = make_fake_ace(tmp)
+            with ace.AceParser(grm, executable=executable) as parser:
+                response = parser.interact('a')
+            result = response['RESULTS'][0]
+            # results are plain, mutable, serializable dicts by default
+            self.assertIs(type(result), dict)
+            result['MRS'] = '[ LTOP: h1 ]'
+            json.dumps(response)
+            with ace.AceParser(grm, executable=executable,
+                               lazy=True) as parser:
+                response = parser.interact('a')
+            result = response['RESULTS'][0]
+            self.assertIsInstance(result, ace.AceResult)
+            self.assertEqual(dict(result), {'MRS': '[ LTOP: h0 ]',
+                                            'DERIV': '(derivation 0)'})
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestAceStats(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_note_stats(self):
+        self.assertEqual(
+            ace.note_stats('2 readings, added 1254 / 368 edges to chart (96 '
+                           'fully instantiated, 85 actives used, 66 '
+                           'passives used)\tRAM: 5620k'),
+            {'readings': 2, 'edges': 1254, 'edges_total': 368,
+             'fully_instantiated': 96, 'actives_used': 85,
+             'passives_used': 66, 'ram_kb': 5620}
+        )
+        self.assertEqual(
+            ace.note_stats('2 passive, 3 active edges in final generation '
+                           'chart; built 2 passives total. [1 results]'),
+            {'passive_edges': 2, 'active_edges': 3, 'passives_built': 2,
+             'results': 1}
+        )
+        self.assertEqual(ace.note_stats('hello'), {})
+
+    def test_response_stats(self):
+        with ace.AceParser(self.grm, executable=self.ace) as parser:
+            response = parser.interact('a b')
+            self.assertEqual(response['STATS']['readings'], 2)
+            self.assertEqual(response['STATS']['ram_kb'], 1024)
+            self.assertGreater(response['STATS']['latency'], 0)
+            responses = list(parser.interact_many(['a', 'b c']))
+            self.assertEqual([r['STATS']['readings'] for r in responses],
+                             [1, 2])
+            self.assertTrue(all(r['STATS']['latency'] >= r['STATS']['send']
+                                for r in responses))
+        self.assertEqual(parser.summary['time'], 0.01234)
+        with ace.AceGenerator(self.grm, executable=self.ace) as generator:
+            response = generator.interact('[ a ]')
+        self.assertEqual(response['STATS']['results'], 1)
+        self.assertIsNotNone(response['NOTE'])
+
+
+class TestAceLimits(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+        self.grace = ace._timeout_grace
+        ace._timeout_grace = 0
+
+    def tearDown(self):
+        ace._timeout_grace = self.grace
+        shutil.rmtree(self.tmp)
+
+    def test_arguments(self):
+        with ace.AceParser(self.grm, executable=self.ace, timeout=2.5,
+                           max_chart_megabytes=1200,
+                           max_unpack_megabytes=1500) as parser:
+            self.assertEqual(parser._p.args[3:],
+                             ['--timeout=3', '--max-chart-megabytes=1200',
+                              '--max-unpack-megabytes=1500'])
+        with ace.AceParser(self.grm, executable=self.ace,
+                           max_results=5) as parser:
+            self.assertEqual(parser._p.args[3:], ['-n', '5'])
+
+    def test_timeout(self):
+        with ace.AceParser(self.grm, executable=self.ace,
+                           timeout=0.3) as parser:
+            responses = list(parser.interact_many(['a', 'sleep 10', 'b']))
+        self.assertEqual([r['TIMEOUT'] for r in responses],
+                         [False, True, False])
+        self.assertEqual(responses[1]['RESULTS'], [])
+        self.assertEqual(len(responses[1]['ERRORS']), 1)
+        self.assertEqual(responses[2]['SENT'], 'b')
+        # inputs after a timed-out one are pipelined and sent again
+        with ace.AceParser(self.grm, executable=self.ace,
+                           timeout=0.3) as parser:
+            data = ['a', 'sleep 10', 'b', 'c d', 'e']
+            responses = list(parser.interact_many(data, batch_size=5))
+        self.assertEqual([r['SENT'] for r in responses],
+                         ['a', None, 'b', 'c d', 'e'])
+
+    def test_timeout_after_response(self):
+        with ace.AceParser(self.grm, executable=self.ace,
+                           timeout=10) as parser:
+            self.assertEqual(parser.interact('a')['SENT'], 'a')
+            # a watchdog firing after the response was read does not
+            # kill the process
+            parser._expire()
+            self.assertTrue(parser.alive())
+            self.assertEqual(parser.interact('b')['SENT'], 'b')
+            # one firing after the response was complete but before it
+            # was cancelled kills the process, but keeps the response
+            receive = parser.receive
+
+            def late_receive():
+                response = receive()
+                parser._expire()
+                return response
+
+            with mock.patch.object(parser, 'receive', late_receive):
+                response = parser.interact('c')
+            self.assertEqual(response['SENT'], 'c')
+            self.assertFalse(response['TIMEOUT'])
+            self.assertTrue(parser.alive())
+            self.assertEqual(parser.interact('d')['SENT'], 'd')
+
+
+class TestAcePool(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_ordered(self):
+        data = ['sleep 0.2', 'a b', 'c', 'd e f'] * 3
+        responses = list(ace.parse_from_iterable(
+            self.grm, data, processes=3, executable=self.ace
+        ))
+        self.assertEqual([r['SENT'] for r in responses], data)
+
+    def test_unordered(self):
+        data = ['sleep 0.3', 'a', 'b', 'c']
+        with ace.AcePool(self.grm, processes=2,
+                         executable=self.ace) as pool:
+            responses = list(pool.interact_many(data, ordered=False))
+            self.assertEqual(sorted(r['SENT'] for r in responses),
+                             sorted(data))
+            self.assertEqual(responses[-1]['SENT'], 'sleep 0.3')
+            # the pool can be used again
+            responses = list(pool.interact_many(['x', 'y']))
+            self.assertEqual([r['SENT'] for r in responses], ['x', 'y'])
+
+    def test_restart(self):
+        with ace.AcePool(self.grm, processes=2,
+                         executable=self.ace) as pool:
+            responses = list(pool.interact_many(['a', 'crash', 'b', 'c']))
+            self.assertEqual([r['SENT'] for r in responses],
+                             ['a', None, 'b', 'c'])
+            self.assertEqual(len(responses[1]['ERRORS']), 1)
+            self.assertTrue(all(p.alive() for p in pool.processes))
+        with ace.AcePool(self.grm, processes=1, cls=ace.AceGenerator,
+                         executable=self.ace) as pool:
+            responses = list(pool.interact_many(['crash', '[ a ]']))
+            self.assertIsNotNone(responses[0]['ERROR'])
+            self.assertEqual(responses[1]['RESULTS'], ['Generated [ a ].'])
+
+
+class TestParseProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+        self.source = make_profile(self.tmp)
+        self.dest = os.path.join(self.tmp, 'parsed')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def parse(self, **kwargs):
+        return ace.parse_profile(self.grm, self.source, self.dest,
+                                 processes=2, executable=self.ace, **kwargs)
+
+    def test_parse_profile(self):
+        self.assertEqual(self.parse(), 3)
+        prof = itsdb.ItsdbProfile(self.dest, index=False)
+        parses = list(prof.read_table('parse'))
+        self.assertEqual([(r['parse-id'], r['i-id'], r['readings'])
+                          for r in parses],
+                         [('1', '10', '3'), ('2', '20', '4'),
+                          ('3', '30', '3')])
+        self.assertEqual(len(list(prof.read_table('result'))), 10)
+        self.assertEqual(len(list(prof.read_table('run'))), 1)
+        # everything is parsed, so nothing is left to do
+        self.assertEqual(self.parse(), 0)
+
+    def test_resume(self):
+        interact_many = ace.AcePool.interact_many
+
+        def interrupted(pool, data, **kwargs):
+            responses = interact_many(pool, data, **kwargs)
+            yield next(responses)
+            yield next(responses)
+            raise KeyboardInterrupt
+
+        with mock.patch.object(ace.AcePool, 'interact_many', interrupted):
+            self.assertRaises(KeyboardInterrupt, self.parse, batch_size=1)
+        self.assertEqual(self.parse(batch_size=1), 1)
+        prof = itsdb.ItsdbProfile(self.dest, index=False)
+        self.assertEqual(
+            [(r['parse-id'], r['i-id']) for r in prof.read_table('parse')],
+            [('1', '10'), ('2', '20'), ('3', '30')]
+        )
+        self.assertEqual(
+            [r['parse-id'] for r in prof.read_table('result')],
+            ['1'] * 3 + ['2'] * 4 + ['3'] * 3
+        )
+
+
+class TestAceGenerator(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.ace, self.grm = make_fake_ace(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_generate(self):
+        responses = list(ace.generate_from_iterable(
+            self.grm, ['[ a ]', '[ b ]'], executable=self.ace
+        ))
+        self.assertEqual([r['RESULTS'] for r in responses],
+                         [['Generated [ a ].'], ['Generated [ b ].']])
+
+    def test_xmrs_input(self):
+        simplemrs = mock.Mock()
+        simplemrs.dumps_one.side_effect = lambda m, **kw: '[ {} ]\n'.format(m)
+        xmrs = [mock.Mock(__str__=lambda self, n=n: n) for n in 'abc']
+        module = mock.Mock(simplemrs=simplemrs)
+        with mock.patch.dict('sys.modules', {'delphin.mrs': module}):
+            for processes in (None, 2):
+                responses = list(ace.generate_from_iterable(
+                    self.grm, xmrs, processes=processes, executable=self.ace
+                ))
+                self.assertEqual([r['RESULTS'] for r in responses],
+                                 [['Generated [ a ].'], ['Generated [ b ].'],
+                                  ['Generated [ c ].']])
+
+    def test_batches(self):
+        data = ['[ {} ]'.format(i) for i in range(50)]
+        batches = []
+        with ace.AceGenerator(self.grm, executable=self.ace) as generator:
+            send_many = generator.send_many
+
+            def record(batch):
+                batches.append(len(batch))
+                send_many(batch)
+
+            generator.send_many = record
+            responses = list(generator.interact_many(data, in_flight=4,
+                                                     batch_size=4))
+        self.assertEqual([r['RESULTS'][0] for r in responses],
+                         ['Generated {}.'.format(d) for d in data])
+        self.assertEqual(batches[0], 4)
+        self.assertEqual(sum(batches), 50)
+
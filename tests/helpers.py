@@ -0,0 +1,103 @@
+# -*- coding: UTF-8 -*-
+"""
+Shared fixtures for the tests that need a profile on disk: a small
+[incr tsdb()] profile and a temporary cache directory.
+"""
+import os
+import shutil
+import tempfile
+
+_relations = '''item:
+  i-id :integer :key
+  i-input :string
+  i-wf :integer
+  i-length :integer
+
+parse:
+  parse-id :integer :key
+  i-id :integer :key
+  readings :integer
+  total :integer
+
+result:
+  parse-id :integer :key
+  result-id :integer
+  mrs :string
+
+phenomenon:
+  p-id :integer :key
+
+item-phenomenon:
+  ip-id :integer :key
+
+set:
+  s-id :integer :key
+
+run:
+  run-id :integer :key
+
+edge:
+  e-id :integer :key
+
+fold:
+  f-id :integer :key
+'''
+
+item_rows = [
+    '10@The dog barks.@1@3',
+    '20@The cat meows\\s loudly.@1@4',
+    '30@Ungrammatical dog the.@0@3',
+]
+
+parse_rows = [
+    '1@10@2@120',
+    '2@20@1@80',
+    '3@30@0@35',
+]
+
+result_rows = [
+    '1@0@[ TOP: h0 ]',
+    '1@1@[ TOP: h1 ]',
+    '2@0@[ TOP: h2 ]',
+]
+
+_cache_env = {}
+
+
+def use_temporary_cache():
+    """Point the profile cache at a new temporary directory."""
+    # keep derived data out of the user's real cache directory
+    _cache_env['old'] = os.environ.get('XDG_CACHE_HOME')
+    _cache_env['tmp'] = tempfile.mkdtemp()
+    os.environ['XDG_CACHE_HOME'] = _cache_env['tmp']
+
+
+def restore_cache():
+    """Restore the cache setting from :func:`use_temporary_cache`."""
+    if _cache_env['old'] is None:
+        del os.environ['XDG_CACHE_HOME']
+    else:
+        os.environ['XDG_CACHE_HOME'] = _cache_env['old']
+    shutil.rmtree(_cache_env['tmp'])
+
+
+def make_profile(root, gzip_tables=()):
+    """Write a small test profile to `root` and return its path."""
+    path = os.path.join(root, 'profile')
+    os.makedirs(path)
+    with open(os.path.join(path, 'relations'), 'w') as f:
+        f.write(_relations)
+    tables = [('item', item_rows), ('parse', parse_rows),
+              ('result', result_rows)]
+    tables.extend((name, []) for name in ('phenomenon', 'item-phenomenon',
+                                          'set', 'run', 'edge', 'fold'))
+    for table, lines in tables:
+        data = ''.join(line + '\n' for line in lines)
+        if table in gzip_tables:
+            import gzip
+            with gzip.open(os.path.join(path, table + '.gz'), 'wt') as f:
+                f.write(data)
+        else:
+            with open(os.path.join(path, table), 'w') as f:
+                f.write(data)
+    return path
@@ -0,0 +1,856 @@
+# -*- coding: UTF-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from delphin import itsdb
+
+from tests.helpers import (
+    item_rows, parse_rows, result_rows, make_profile,
+    use_temporary_cache, restore_cache
+)
+
+
+def setUpModule():
+    use_temporary_cache()
+
+
+def tearDownModule():
+    restore_cache()
+
+
+class TestItsdbProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp, gzip_tables=('result',))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_read_columns(self):
+        prof = itsdb.ItsdbProfile(self.path, index=False)
+        cols = prof.read_columns('item', ['i-id', 'i-input'])
+        self.assertEqual(list(cols), ['i-id', 'i-input'])
+        self.assertEqual(len(cols['i-id']), 3)
+        self.assertEqual(list(cols['i-id']), ['10', '20', '30'])
+        self.assertEqual(cols['i-input'][1], 'The cat meows@ loudly.')
+        self.assertEqual(cols['i-input'][-1], 'Ungrammatical dog the.')
+        self.assertEqual(cols['i-id'][1:], ['20', '30'])
+        self.assertRaises(IndexError, cols['i-id'].__getitem__, 3)
+        self.assertRaises(itsdb.ItsdbError, prof.read_columns,
+                          'item', ['mrs'])
+        self.assertEqual(cols['i-input'][::2],
+                         ['The dog barks.', 'Ungrammatical dog the.'])
+        self.assertFalse(cols.closed)
+        cols.close()
+        self.assertTrue(cols.closed)
+        # gzipped tables are decompressed into a cache
+        with prof.read_columns('result', ['mrs']) as cols:
+            mrs = cols['mrs']
+            self.assertEqual(list(mrs), [r.split('@')[2] for r in result_rows])
+        self.assertTrue(cols.closed)
+        with prof.read_columns('parse', typed=True) as cols:
+            self.assertEqual(list(cols['readings']), [2, 1, 0])
+
+    def test_read_columns_replaced_gzip(self):
+        import gzip
+        prof = itsdb.ItsdbProfile(self.path, index=False)
+        with prof.read_columns('result', ['mrs']) as cols:
+            self.assertEqual(len(cols['mrs']), 3)
+        # replace the gzipped table with one that looks older than the
+        # decompressed copy
+        gz_filename = os.path.join(self.path, 'result.gz')
+        with gzip.open(gz_filename, 'wt') as f:
+            f.write('9@0@[ TOP: h9 ]\n')
+        os.utime(gz_filename, (0, 0))
+        with prof.read_columns('result', ['mrs']) as cols:
+            self.assertEqual(list(cols['mrs']), ['[ TOP: h9 ]'])
+
+    def test_select_columnar(self):
+        import warnings
+        prof = itsdb.ItsdbProfile(self.path)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', ResourceWarning)
+            self.assertEqual(
+                list(prof.select('result', ['mrs'], columnar=True,
+                                 typed=True)),
+                [['[ TOP: h0 ]'], ['[ TOP: h1 ]'], ['[ TOP: h2 ]']]
+            )
+        rows = list(prof.select('item', ['i-id', 'i-wf']))
+        self.assertEqual(
+            list(prof.select('item', ['i-id', 'i-wf'], columnar=True)),
+            rows
+        )
+        self.assertEqual(
+            list(prof.select('item', ['i-id'], mode='row', columnar=True)),
+            ['10', '20', '30']
+        )
+        prof.add_filter('item', ['i-wf'], lambda row, x: x == '1')
+        self.assertEqual(
+            list(prof.select('item', ['i-id'], columnar=True)),
+            [['10'], ['20']]
+        )
+        # key filters from the index cascade to the columnar read
+        prof = itsdb.ItsdbProfile(
+            self.path, filters=[('item', ['i-wf'], lambda row, x: x == '1')]
+        )
+        self.assertEqual(
+            list(prof.select('parse', ['parse-id'], columnar=True)),
+            [['1'], ['2']]
+        )
+
+    def test_key_index(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        self.assertEqual(list(prof.read_table('item')),
+                         list(prof.read_raw_table('item')))
+        offsets = prof.key_offsets('result', 'parse-id')
+        self.assertEqual(sorted(offsets), ['1', '2'])
+        self.assertEqual(len(offsets['1']), 2)
+        idx = prof._key_index_filename('result', 'parse-id')
+        self.assertTrue(os.path.exists(idx))
+        # derived data is kept out of the profile
+        self.assertFalse(idx.startswith(self.path))
+        self.assertEqual(sorted(os.listdir(self.path)),
+                         sorted(['relations', 'item', 'parse', 'result.gz',
+                                 'phenomenon', 'item-phenomenon', 'set',
+                                 'run', 'edge', 'fold']))
+        # a new profile object reuses the persisted index
+        prof2 = itsdb.ItsdbProfile(self.path)
+        self.assertEqual(prof2.key_offsets('result', 'parse-id'), offsets)
+        # orphaned rows are still removed by the cascade
+        with open(os.path.join(self.path, 'parse'), 'a') as f:
+            f.write('4@40@1@10\n')
+        prof3 = itsdb.ItsdbProfile(self.path)
+        self.assertEqual([r['parse-id'] for r in prof3.read_table('parse')],
+                         ['1', '2', '3'])
+        self.assertEqual(len(prof3.key_offsets('parse', 'parse-id')), 4)
+
+    def test_key_index_is_not_executed(self):
+        import pickle
+
+        class Payload(object):
+            def __reduce__(self):
+                return (os.mkdir, (os.path.join(self_tmp, 'pwned'),))
+
+        self_tmp = self.tmp
+        prof = itsdb.ItsdbProfile(self.path, index=False)
+        idx = prof._key_index_filename('item', 'i-id')
+        with open(idx, 'wb') as f:
+            pickle.dump(Payload(), f)
+        offsets = prof.key_offsets('item', 'i-id')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'pwned')))
+        self.assertEqual(sorted(offsets), ['10', '20', '30'])
+        # the malformed index was replaced by a valid one
+        prof2 = itsdb.ItsdbProfile(self.path, index=False)
+        self.assertEqual(prof2.key_offsets('item', 'i-id'), offsets)
+
+    def test_cascading_key_filter(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        self.assertIsNone(prof._allowed_rows('result'))
+        prof = itsdb.ItsdbProfile(self.path)
+        prof.add_filter('item', ['i-wf'], lambda row, x: x == '1')
+        self.assertEqual([r['i-id'] for r in prof.read_table('parse')],
+                         ['10', '20'])
+        prof.add_filter('parse', ['readings'], lambda row, x: x == '1')
+        prof._index = None
+        allowed = prof._allowed_rows('result')
+        self.assertEqual(list(allowed), [32])
+        self.assertIs(prof._allowed_rows('result'), allowed)  # cached
+        self.assertEqual([r['mrs'] for r in prof.read_table('result')],
+                         ['[ TOP: h2 ]'])
+        self.assertEqual(len(list(prof.read_table('result',
+                                                  key_filter=False))), 3)
+
+    def test_key_row_offsets(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        allowed = prof._key_row_offsets(
+            'parse', [('parse-id', {'1', '2'}), ('i-id', {'20', '30'})])
+        self.assertEqual(allowed.typecode, 'q')
+        self.assertEqual(list(allowed), [len(parse_rows[0]) + 1])
+        allowed = prof._key_row_offsets(
+            'parse', [('parse-id', {'3', '1'}), ('i-id', {'10', '30'})])
+        self.assertEqual(list(allowed),
+                         [0, len(parse_rows[0] + parse_rows[1]) + 2])
+        self.assertIsNone(prof._key_row_offsets(
+            'parse', [('i-id', {'10', '20', '30'})]))
+
+    def test_limit_and_sample(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        ids = lambda rows: [r['i-id'] for r in rows]
+        self.assertEqual(ids(prof.read_table('item', limit=2)), ['10', '20'])
+        self.assertEqual(ids(prof.read_table('item', offset=1)),
+                         ['20', '30'])
+        self.assertEqual(ids(prof.read_table('item', limit=1, offset=2)),
+                         ['30'])
+        # plain limits and small offsets stream without the key index
+        unindexed = itsdb.ItsdbProfile(self.path, index=False)
+        self.assertEqual(ids(unindexed.read_table('item', limit=2)),
+                         ['10', '20'])
+        self.assertEqual(unindexed._key_offsets, {})
+        original = itsdb._seek_offset
+        itsdb._seek_offset = 1
+        try:
+            self.assertEqual(ids(unindexed.read_table('item', offset=1)),
+                             ['20', '30'])
+            self.assertIn(('item', 'i-id'), unindexed._key_offsets)
+        finally:
+            itsdb._seek_offset = original
+        sample = ids(prof.read_table('item', sample=2, seed=1))
+        self.assertEqual(len(sample), 2)
+        self.assertEqual(sample, sorted(sample))  # table order is kept
+        self.assertEqual(ids(prof.read_table('item', sample=2, seed=1)),
+                         sample)
+        self.assertEqual(len(list(prof.read_table('item', sample=1.0))), 3)
+        self.assertEqual(
+            list(prof.select('result', ['mrs'], limit=1, offset=1,
+                             columnar=True)),
+            [['[ TOP: h1 ]']]
+        )
+        # a filter that passes every row forces the streamed path,
+        # which samples the same rows as the key index
+        streamed = itsdb.ItsdbProfile(self.path)
+        streamed.add_filter('item', None, 'i-id > 0')
+        for seed in range(5):
+            self.assertEqual(
+                ids(streamed.read_table('item', sample=2, seed=seed)),
+                ids(prof.read_table('item', sample=2, seed=seed)))
+        # with filters, rows are sliced after filtering
+        prof.add_filter('item', None, 'i-wf = 1')
+        self.assertEqual(ids(prof.read_table('item', offset=1)), ['20'])
+        # stride sampling picks the same rows from the index or a stream
+        self.assertEqual(
+            list(itsdb.sample_rows(range(10), 0.25, seed=3)),
+            [list(range(10))[i] for i in itsdb._sample_positions(10, 0.25, 3)]
+        )
+        for seed in range(5):
+            self.assertEqual(list(itsdb.sample_rows(range(50), 7, seed=seed)),
+                             itsdb._sample_positions(50, 7, seed))
+        self.assertRaises(itsdb.ItsdbError, list,
+                          itsdb.sample_rows(range(10), 1.5))
+        self.assertRaises(itsdb.ItsdbError, list,
+                          itsdb.limit_rows(range(10), -1))
+
+    def test_get(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        rows = prof.get('item', '20')
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['i-input'], 'The cat meows@ loudly.')
+        self.assertEqual(prof.get('item', 99), [])
+        self.assertEqual([r['result-id'] for r in prof.get('result', 1)],
+                         ['0', '1'])
+        self.assertEqual(
+            [r['i-id'] for r in prof.get_many('parse', [30, 10], col='i-id')],
+            ['30', '10']
+        )
+        prof.add_filter('result', ['result-id'], lambda row, x: x == '1')
+        self.assertEqual(len(prof.get('result', 1)), 1)
+        self.assertRaises(itsdb.ItsdbError, prof.get, 'item', 1, 'i-foo')
+
+    def test_filter_expressions(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        prof.add_filter('item', None, 'i-wf = 1')
+        prof.add_filter('item', None, 'i-length in 3..3 or i-input ~ "cat"')
+        self.assertEqual(len(prof.filters['item']), 1)  # fused
+        self.assertEqual([r['i-id'] for r in prof.read_table('item')],
+                         ['10', '20'])
+        self.assertEqual(list(prof.select('item', ['i-id'], columnar=True)),
+                         [['10'], ['20']])
+        prof.add_filter('item', None, 'not i-id in {10, 30}')
+        self.assertEqual([r['i-id'] for r in prof.read_table('item')],
+                         ['20'])
+        self.assertRaises(itsdb.ItsdbError, prof.add_filter,
+                          'item', None, 'i-foo = 1')
+        self.assertRaises(itsdb.ItsdbError, prof.add_filter,
+                          'item', None, 'i-id = "abc"')
+        self.assertRaises(itsdb.ItsdbError, prof.add_filter,
+                          'item', None, 'i-id <')
+
+
+class TestCompileFilter(unittest.TestCase):
+    def test_untyped(self):
+        f = itsdb.compile_filter('x >= 1.5 and y != "a b"')
+        self.assertEqual(f.columns, ['x', 'y'])
+        self.assertTrue(f({'x': '2', 'y': 'c'}, None))
+        self.assertFalse(f({'x': '1', 'y': 'c'}, None))
+        self.assertFalse(f({'x': 'abc', 'y': 'c'}, None))
+        self.assertFalse(f({'y': 'c'}, None))
+        f = itsdb.compile_filter('x in {"a", "b"}')
+        self.assertTrue(f({'x': 'a'}, None))
+        self.assertFalse(f({'x': 'c'}, None))
+
+    def test_typed(self):
+        fields = [itsdb.Field('i-id', ':integer', True, [], None)]
+        f = itsdb.compile_filter('i-id in 1..10', fields)
+        self.assertTrue(f({'i-id': '10'}, None))
+        self.assertTrue(f({'i-id': 1}, None))
+        self.assertFalse(f({'i-id': '11'}, None))
+        f = itsdb.compile_filter('i-id ~ "^1"', fields)
+        self.assertTrue(f({'i-id': '12'}, None))
+        # non-integer values are not truncated
+        for expression, expected in [('i-id < 0.5', True),
+                                     ('i-id >= 0.5', False),
+                                     ('i-id = 0.5', False),
+                                     ('i-id = 0.0', True)]:
+            f = itsdb.compile_filter(expression, fields)
+            self.assertEqual(f({'i-id': '0'}, None), expected, expression)
+        self.assertRaises(itsdb.ItsdbError, itsdb.compile_filter,
+                          'i-id = "a"', fields)
+
+    def test_runs_once_per_row(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            prof = itsdb.ItsdbProfile(make_profile(tmp), index=False)
+            prof.add_filter('item', ['i-id', 'i-wf'], 'i-wf = 1')
+            self.assertEqual(prof.filters['item'][0][0], [None])
+            calls = []
+            condition = prof.filters['item'][0][1]
+
+            def counted(row, x):
+                calls.append(row['i-id'])
+                return condition(row, x)
+
+            counted.expression = condition.expression
+            counted.columns = condition.columns
+            prof.filters['item'][0] = ([None], counted)
+            self.assertEqual(len(list(prof.read_table('item'))), 2)
+            self.assertEqual(calls, ['10', '20', '30'])
+        finally:
+            shutil.rmtree(tmp)
+
+
+class TestTypedValues(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_typed_value(self):
+        self.assertEqual(itsdb.typed_value('12', ':integer'), 12)
+        self.assertEqual(itsdb.typed_value('', ':integer'), None)
+        self.assertEqual(itsdb.typed_value('abc', ':string'), 'abc')
+        self.assertEqual(itsdb.typed_value('8-sep-2006 14:24:57', ':date'),
+                         datetime(2006, 9, 8, 14, 24, 57))
+        self.assertEqual(itsdb.typed_value('soon', ':date'), 'soon')
+
+    def test_typed_reads(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        row = next(prof.read_table('parse', typed=True))
+        self.assertEqual(row['readings'], 2)
+        self.assertEqual(next(prof.read_raw_table('item', typed=True)),
+                         {'i-id': 10, 'i-input': 'The dog barks.',
+                          'i-wf': 1, 'i-length': 3})
+        expected = [[10, 'The dog barks.'], [20, 'The cat meows@ loudly.']]
+        prof.add_filter('item', None, 'i-wf = 1')
+        for columnar in (False, True):
+            self.assertEqual(
+                list(prof.select('item', ['i-id', 'i-input'], typed=True,
+                                 columnar=columnar)),
+                expected
+            )
+        cols = prof.read_columns('parse', ['total'], typed=True)
+        self.assertEqual(sum(cols['total']), 235)
+        self.assertEqual([r['total'] for r in prof.get('parse', 2, typed=True)],
+                         [80])
+
+
+class TestJoin(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_join(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        rows = list(prof.join('item', 'parse'))
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0]['item:i-id'], '10')
+        self.assertEqual(rows[0]['parse:parse-id'], '1')
+        self.assertEqual(list(rows[0])[:2], ['item:i-id', 'item:i-input'])
+
+    def test_join_tables(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        cols = ['item:i-id', 'parse:parse-id', 'result:result-id']
+        expected = [('10', '1', '0'), ('10', '1', '1'), ('20', '2', '0')]
+        self.assertEqual(
+            list(prof.join_tables(['item', 'parse', 'result'], cols=cols)),
+            expected
+        )
+        self.assertEqual(len(next(prof.join_tables(['item', 'parse']))), 8)
+        self.assertRaises(itsdb.ItsdbError, list,
+                          prof.join_tables(['item', 'result'], cols=cols))
+        self.assertRaises(itsdb.ItsdbError, list,
+                          prof.join_tables(['item', 'run']))
+
+    def test_join_unsorted(self):
+        # reverse the result and parse tables so they cannot be merged
+        for table in ('parse', 'result'):
+            fn = os.path.join(self.path, table)
+            with open(fn) as f:
+                lines = f.readlines()
+            with open(fn, 'w') as f:
+                f.writelines(reversed(lines))
+        prof = itsdb.ItsdbProfile(self.path)
+        cols = ['item:i-id', 'parse:parse-id', 'result:result-id']
+        self.assertEqual(
+            list(prof.join_tables(['item', 'parse', 'result'], cols=cols)),
+            [('10', '1', '1'), ('10', '1', '0'), ('20', '2', '0')]
+        )
+        # a smaller first table still gives rows in first-table order
+        with open(os.path.join(self.path, 'parse'), 'a') as f:
+            f.write('4@30@0@35\n5@10@0@35\n')
+        prof = itsdb.ItsdbProfile(self.path)
+        self.assertEqual(
+            list(prof.join_tables(['item', 'parse'],
+                                  cols=['item:i-id', 'parse:parse-id'])),
+            [('10', '1'), ('10', '5'), ('20', '2'), ('30', '3'), ('30', '4')]
+        )
+        self.assertEqual(
+            list(prof.join_tables(['result', 'parse'],
+                                  cols=['result:result-id', 'parse:i-id'])),
+            [('0', '20'), ('1', '10'), ('0', '10')]
+        )
+
+    def test_merge_cursor_fallback(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        # parse rows ordered by descending i-id force backward lookups
+        rows = [(r,) for r in reversed(list(prof.read_table('parse')))]
+        joined = prof._join_step(iter(rows), ['parse'], 0, 'result',
+                                 'parse-id', True)
+        self.assertEqual([(j[0]['parse-id'], j[1]['result-id'])
+                          for j in joined],
+                         [('2', '0'), ('1', '0'), ('1', '1')])
+
+    def test_merge_cursor_key_order(self):
+        rows = [{'k': '01'}, {'k': '2'}, {'k': '02'}, {'k': '3'}]
+        cursor = itsdb._MergeCursor(rows, 'k', lambda value: ['fallback'])
+        self.assertEqual(cursor.lookup('1'), [{'k': '01'}])
+        self.assertEqual(cursor.lookup('2'), [{'k': '2'}, {'k': '02'}])
+        self.assertEqual(cursor.lookup('002'), [{'k': '2'}, {'k': '02'}])
+        self.assertEqual(cursor.lookup('1'), ['fallback'])
+        self.assertEqual(cursor.lookup('3'), [{'k': '3'}])
+
+
+class TestMatchRows(unittest.TestCase):
+    def rows(self, values):
+        return [{'k': str(v), 'n': i} for i, v in enumerate(values)]
+
+    def matched(self, *args, **kwargs):
+        return [(v, [r['n'] for r in left], [r['n'] for r in right])
+                for v, left, right in itsdb.match_rows(*args, **kwargs)]
+
+    def test_presorted(self):
+        left = self.rows([1, 2, 2, 10])
+        right = self.rows([2, 3, 10, 10])
+        expected = [('1', [0], []), ('2', [1, 2], [0]), ('3', [], [1]),
+                    ('10', [3], [2, 3])]
+        self.assertEqual(self.matched(left, right, 'k', presorted=True),
+                         expected)
+        self.assertEqual(self.matched(left, right, 'k'), expected)
+        self.assertRaises(itsdb.ItsdbError, self.matched,
+                          self.rows([2, 1]), [], 'k', presorted=True)
+        self.assertRaises(itsdb.ItsdbError, self.matched,
+                          self.rows([1, 2, 1]), [], 'k', presorted=True)
+
+    def test_external_sort(self):
+        left = self.rows([10, 3, 2, 3, 1, 2])
+        right = self.rows([2, 10, 4])
+        self.assertEqual(
+            self.matched(left, right, 'k', buffer_size=2),
+            [('1', [4], []), ('2', [2, 5], [0]), ('3', [1, 3], []),
+             ('4', [], [2]), ('10', [0], [1])]
+        )
+        self.assertEqual(
+            [v for v, _, _ in itsdb.match_rows(left, right, 'k',
+                                               sort_keys=False)],
+            ['10', '3', '2', '1', '4']
+        )
+
+
+class TestDiff(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.gold = make_profile(os.path.join(self.tmp, 'gold'))
+        self.test = make_profile(os.path.join(self.tmp, 'test'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_diff_rows(self):
+        left = [{'k': '1', 'a': 'x', 't': '10'},
+                {'k': '2', 'a': 'y', 't': '20'}]
+        right = [{'k': '2', 'a': 'z', 't': '25'},
+                 {'k': '3', 'a': 'z', 't': '5'}]
+        self.assertEqual(
+            [(v, status, dict(changes), dict(deltas)) for v, status, changes,
+             deltas in itsdb.diff_rows(left, right, 'k', measures=['t'])],
+            [('1', 'removed', {}, {}),
+             ('2', 'changed', {'a': ('y', 'z')}, {'t': 5}),
+             ('3', 'added', {}, {})]
+        )
+
+    def test_diff_profiles(self):
+        # the test run has new parse-ids, one fewer reading for item 10,
+        # different timings, and no results for item 20
+        with open(os.path.join(self.test, 'parse'), 'w') as f:
+            f.write('11@10@1@100\n12@20@1@90\n13@30@0@30\n')
+        with open(os.path.join(self.test, 'result'), 'w') as f:
+            f.write('11@0@[ TOP: h0 ]\n')
+        gold = itsdb.ItsdbProfile(self.gold)
+        test = itsdb.ItsdbProfile(self.test)
+        diff = itsdb.diff_profiles(gold, test)
+        self.assertEqual(list(diff), ['item', 'parse', 'result'])
+        self.assertEqual(diff['item'].same, 3)
+        self.assertEqual(diff['parse'].key, 'i-id')
+        self.assertEqual(dict(diff['parse'].changed),
+                         {'10': {'readings': ('2', '1')}})
+        self.assertEqual(diff['parse'].same, 2)
+        self.assertEqual(diff['parse'].deltas['total'], -15)
+        # only timing, memory, and chart statistics are measured
+        self.assertEqual(list(diff['parse'].deltas), ['total'])
+        self.assertEqual(list(diff['item'].deltas), [])
+        # results are matched on the i-id of their parse and result-id
+        self.assertEqual(diff['result'].key, ('i-id', 'result-id'))
+        self.assertEqual(diff['result'].removed,
+                         [('10', '1'), ('20', '0')])
+        self.assertEqual(diff['result'].added, [])
+        self.assertEqual(diff['result'].same, 1)
+        diff = itsdb.diff_profiles(gold, test, tables=['parse'],
+                                   measures=['readings'])
+        self.assertEqual(dict(diff['parse'].deltas), {'readings': -1})
+        self.assertEqual(dict(diff['parse'].changed),
+                         {'10': {'total': ('120', '100')},
+                          '20': {'total': ('80', '90')},
+                          '30': {'total': ('35', '30')}})
+
+
+class TestProfileSet(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = []
+        for name in ('a', 'b', 'c'):
+            os.makedirs(os.path.join(self.tmp, name))
+            self.paths.append(make_profile(os.path.join(self.tmp, name)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_select(self):
+        for workers in (0, 2):
+            profs = itsdb.ProfileSet(self.paths, workers=workers,
+                                     filters=[('item', None, 'i-wf = 1')])
+            results = list(profs.select('item', ['i-id']))
+            self.assertEqual([path for path, _ in results], self.paths)
+            self.assertEqual(results[0][1], [['10'], ['20']])
+            self.assertEqual(list(profs.timings), self.paths)
+
+    def test_map(self):
+        profs = itsdb.ProfileSet(self.paths, workers=2)
+        results = list(profs.map(itsdb.ItsdbProfile.get, 'item', 30))
+        self.assertEqual([len(rows) for _, rows in results], [1, 1, 1])
+        rows = dict(profs.read_table('parse', typed=True))
+        self.assertEqual(rows[self.paths[1]][0]['total'], 120)
+
+
+class TestParallelFiltering(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp, gzip_tables=('result',))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_chunk_ranges(self):
+        fn = os.path.join(self.path, 'item')
+        ranges = itsdb._chunk_ranges(fn, 5)
+        self.assertEqual(len(ranges), 3)
+        self.assertEqual(ranges[-1][1], os.path.getsize(fn))
+        fields = itsdb.ItsdbProfile(self.path).table_relations('item')
+        offsets = list(itsdb._scan_chunks_parallel(
+            fn, fields, [('i-wf = 1', fields)], 2, chunk_size=5))
+        self.assertEqual(offsets, [0, len(item_rows[0]) + 1])
+
+    def test_read_table_workers(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        prof.add_filter('item', None, 'i-input ~ "@"')
+        prof.add_filter('result', None, 'result-id = 0')
+        for table in ('item', 'parse', 'result'):
+            self.assertEqual(list(prof.read_table(table, workers=2)),
+                             list(prof.read_table(table)))
+        self.assertEqual(len(list(prof.read_table('result', workers=2))), 1)
+        self.assertEqual(
+            [r['i-id'] for r in prof.read_table('item', workers=2)], ['20'])
+        # key filters are applied to the offsets from the workers
+        prof.add_filter('parse', None, 'readings > 0')
+        self.assertEqual(
+            [r['parse-id'] for r in prof.read_table('parse', workers=2)],
+            ['2'])
+        self.assertEqual(
+            list(prof.read_table('parse', workers=2, typed=True)),
+            list(prof.read_table('parse', typed=True)))
+
+    def test_intersect_sorted(self):
+        self.assertEqual(list(itsdb._intersect_sorted([1, 3, 5, 7],
+                                                      [2, 3, 7, 9])),
+                         [3, 7])
+        self.assertEqual(list(itsdb._intersect_sorted([5, 6], [1])), [])
+
+
+class TestEncoding(unittest.TestCase):
+    def test_decode_row(self):
+        self.assertEqual(itsdb.decode_row('1@abc@@\n'), ['1', 'abc', '', ''])
+        self.assertEqual(itsdb.decode_row('1@a\\sb@c\\nd\\\\s\n'),
+                         ['1', 'a@b', 'c\nd\\s'])
+        self.assertEqual(itsdb.decode_row('\\s' * 40), ['@' * 40])
+        lines = ['1@a\n', '2@b\\sc\n']
+        self.assertEqual(list(itsdb.decode_rows(lines)),
+                         [itsdb.decode_row(line) for line in lines])
+
+    def test_escape(self):
+        self.assertEqual(itsdb.escape('a@b'), 'a\\sb')
+        self.assertEqual(itsdb.escape('a\\b\nc'), 'a\\\\b\\nc')
+        for s in ['@', '\\s', '\\@\n\\\\', 'plain']:
+            self.assertEqual(itsdb.unescape(itsdb.escape(s)), s)
+        fields = ['1', 'a@b', '\\']
+        self.assertEqual(itsdb.decode_row(itsdb.encode_row(fields)), fields)
+
+
+class TestWriting(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_write_gzip_append(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        rows = list(prof.read_table('item'))
+        os.remove(os.path.join(self.path, 'item'))
+        prof.write_table('item', rows[:2], gzip=True, compresslevel=1)
+        prof.write_table('item', rows[2:], gzip=True, append=True)
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'item')))
+        self.assertEqual(list(prof.read_table('item')), rows)
+
+    def test_write_small_batches(self):
+        fn = os.path.join(self.tmp, 'lines')
+        with open(fn, 'wb') as f:
+            itsdb._write_lines(f, ['a@b', 'c', ''], buffer_size=2)
+        with open(fn) as f:
+            self.assertEqual(f.read(), 'a@b\nc\n\n')
+
+    def test_parallel_gzip(self):
+        # any gzip-compatible command works; use plain gzip if present
+        command = itsdb._parallel_gzip_command
+        itsdb._parallel_gzip_command = 'gzip'
+        try:
+            prof = itsdb.ItsdbProfile(self.path)
+            rows = list(prof.read_table('parse'))
+            os.remove(os.path.join(self.path, 'parse'))
+            prof.write_table('parse', rows, gzip=True, parallel_gzip=True)
+            prof.write_table('parse', rows, gzip=True, append=True,
+                             parallel_gzip=True)
+            self.assertEqual(list(prof.read_table('parse')), rows + rows)
+        finally:
+            itsdb._parallel_gzip_command = command
+
+
+class TestAggregate(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_aggregate_rows(self):
+        rows = [{'g': 'a', 'x': '1'}, {'g': 'b', 'x': '4'},
+                {'g': 'a', 'x': '3'}, {'g': 'a', 'x': None}]
+        result = itsdb.aggregate_rows(
+            rows, ['count', 'count(x)', 'sum(x)', 'mean(x)', 'min(x)',
+                   'max(x)', 'median(x)', 'p100(x)'],
+            group_by=['g']
+        )
+        self.assertEqual([list(r.values()) for r in result],
+                         [['a', 3, 2, 4, 2.0, 1, 3, 2.0, 3.0],
+                          ['b', 1, 1, 4, 4.0, 4, 4, 4.0, 4.0]])
+        # untyped numbers are compared numerically, before other values
+        rows = [{'x': '9'}, {'x': '10'}, {'x': 'n/a'}, {'x': '2.5'}]
+        self.assertEqual(itsdb.aggregate_rows(rows, ['min(x)', 'max(x)']),
+                         [{'min(x)': 2.5, 'max(x)': 'n/a'}])
+        self.assertEqual(itsdb.aggregate_rows(rows[:2], ['max(x)']),
+                         [{'max(x)': 10}])
+        self.assertEqual(itsdb.aggregate_rows([], ['count', 'mean(x)']),
+                         [{'count': 0, 'mean(x)': None}])
+        self.assertRaises(itsdb.ItsdbError, itsdb.aggregate_rows,
+                          rows, ['sum'])
+        self.assertRaises(itsdb.ItsdbError, itsdb.aggregate_rows,
+                          rows, ['mode(x)'])
+
+    def test_profile_aggregate(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        result = prof.aggregate('parse', ['count', 'max(total)'])
+        self.assertEqual(result, [{'count': 3, 'max(total)': 120}])
+        result = prof.aggregate(['item', 'parse'],
+                                ['count', 'mean(parse:readings)'],
+                                group_by=['item:i-wf'])
+        self.assertEqual(result, [
+            {'item:i-wf': 1, 'count': 2, 'mean(parse:readings)': 1.5},
+            {'item:i-wf': 0, 'count': 1, 'mean(parse:readings)': 0.0},
+        ])
+
+
+class TestAppendSession(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp, gzip_tables=('result',))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_append(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        offsets = prof.key_offsets('parse', 'i-id')
+        with prof.append_session(buffer_size=10) as session:
+            self.assertEqual(session.last_committed, None)
+            session.append('parse', {'parse-id': 4, 'i-id': 40,
+                                     'readings': 1})
+            session.extend('result', [{'parse-id': 4, 'result-id': 0,
+                                       'mrs': '[ a@b ]'}])
+            session.commit(40)
+        self.assertFalse(os.path.exists(
+            os.path.join(itsdb._profile_cache_dir(self.path),
+                         'append-checkpoint')))
+        self.assertEqual(prof.get('parse', 4)[0]['readings'], '1')
+        self.assertEqual(prof.get('result', 4)[0]['mrs'], '[ a@b ]')
+        self.assertEqual(prof.get('parse', 4)[0]['total'], '-1')
+        # the persisted index was extended, not rebuilt
+        self.assertIs(prof.key_offsets('parse', 'i-id'), offsets)
+        prof2 = itsdb.ItsdbProfile(self.path)
+        self.assertEqual(prof2.key_offsets('parse', 'i-id'), offsets)
+        self.assertEqual(
+            itsdb._scan_key_offsets(os.path.join(self.path, 'parse'), 1),
+            offsets
+        )
+
+    def test_resume(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        parse_fn = os.path.join(self.path, 'parse')
+        size = os.path.getsize(parse_fn)
+        session = prof.append_session()
+        session.append('parse', {'parse-id': 4, 'i-id': 40})
+        session.commit(40)
+        committed = os.path.getsize(parse_fn)
+        self.assertGreater(committed, size)
+        session.append('parse', {'parse-id': 5, 'i-id': 50})
+        session.append('run', {'run-id': 1})
+        session.flush()
+        with open(parse_fn, 'a') as f:
+            f.write('6@6')  # a torn row
+        # simulate a crash: the session is never closed
+        session = itsdb.ItsdbProfile(self.path).append_session()
+        self.assertEqual(session.last_committed, 40)
+        self.assertEqual(os.path.getsize(parse_fn), committed)
+        self.assertEqual(os.path.getsize(os.path.join(self.path, 'run')), 0)
+        session.close()
+
+
+class TestColumnarCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp, gzip_tables=('result',))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_column_encoding(self):
+        def encoding(values):
+            stats = itsdb._ColumnStats()
+            for value in values:
+                stats.add(value)
+            return stats.encoding()
+        self.assertEqual(encoding(['1', '-2', '30']), ('int', 'b'))
+        self.assertEqual(encoding(['1', '70000']), ('int', 'i'))
+        self.assertEqual(encoding(['1', '01']), ('str', None))
+        self.assertEqual(encoding(['1', '']), ('str', None))
+        self.assertEqual(encoding(['a', 'b', 'c']), ('str', None))
+        # dictionary encoding is only used when it is smaller
+        self.assertEqual(encoding(['a', 'b', 'a', 'a']), ('str', None))
+        self.assertEqual(encoding(['long value'] * 4), ('dict', 'B'))
+
+    def test_export(self):
+        prof = itsdb.ItsdbProfile(self.path)
+        expected = dict((t, list(prof.read_table(t)))
+                        for t in ('item', 'parse', 'result'))
+        typed = list(prof.read_table('parse', typed=True))
+        self.assertEqual(len(prof.export_columnar()), 9)
+        meta = prof._columnar_cache('result')
+        self.assertIsNotNone(meta)
+        self.assertEqual(meta['rows'], 3)
+        self.assertEqual([c['kind'] for c in meta['columns']],
+                         ['int', 'int', 'str'])
+        # values are stored one column per file
+        path = prof._columnar_filename('result')
+        self.assertEqual(sorted(os.listdir(path)),
+                         ['0.col', '1.col', '2.col', 'meta.json'])
+        with open(os.path.join(path, '2.col')) as f:
+            self.assertEqual(
+                f.read(), ''.join(r.split('@')[2] + '\n' for r in result_rows))
+        for table, rows in expected.items():
+            self.assertEqual(list(prof.read_table(table)), rows)
+        self.assertEqual(list(prof.read_table('parse', typed=True)), typed)
+        self.assertEqual(list(prof.read_table('item', limit=1)),
+                         expected['item'][:1])
+        # stale caches are ignored
+        with open(os.path.join(self.path, 'item'), 'a') as f:
+            f.write('40@New item.@1@2\n')
+        self.assertIsNone(prof._columnar_cache('item'))
+        self.assertEqual(len(list(prof.read_raw_table('item'))), 4)
+
+
+    def test_export_dictionary_column(self):
+        with open(os.path.join(self.path, 'item'), 'w') as f:
+            for i in range(10):
+                f.write('{}@A repeated\\s sentence.@1@3\n'.format(i))
+        prof = itsdb.ItsdbProfile(self.path)
+        expected = list(prof.read_table('item'))
+        prof.export_columnar(['item'])
+        meta = prof._columnar_cache('item')
+        self.assertEqual(meta['columns'][1]['kind'], 'dict')
+        self.assertEqual(list(prof.read_table('item')), expected)
+        self.assertEqual(expected[0]['i-input'], 'A repeated@ sentence.')
+
+
+class TestInterning(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = make_profile(self.tmp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_intern(self):
+        prof = itsdb.ItsdbProfile(self.path, intern=True)
+        rows = list(prof.read_table('item')) + list(prof.read_table('item'))
+        self.assertIs(rows[0]['i-wf'], rows[1]['i-wf'])
+        self.assertIs(rows[0]['i-input'], rows[3]['i-input'])
+        self.assertEqual(rows[:3], list(itsdb.ItsdbProfile(self.path)
+                                        .read_table('item')))
+        prof = itsdb.ItsdbProfile(self.path, intern=[':string'])
+        rows = list(prof.read_table('item')) + list(prof.read_table('item'))
+        self.assertIs(rows[0]['i-input'], rows[3]['i-input'])
+        # rows looked up by key are interned the same way
+        row = prof.get('item', 10)[0]
+        self.assertIs(row['i-input'], rows[0]['i-input'])
+
+    def test_intern_limit(self):
+        pool = itsdb._InternPool(limit=2)
+        rows = [['a', 'x'], ['b', 'x'], ['c', 'x'], ['a', 'x']]
+        out = list(pool.intern_rows('t', [0, 1], [list(r) for r in rows]))
+        self.assertEqual(out, rows)
+        self.assertIsNone(pool._pools[('t', 0)])
+        self.assertEqual(list(pool._pools[('t', 1)]), ['x'])